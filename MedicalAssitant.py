@@ -1,7 +1,62 @@
 
 import google.generativeai as genai
+import datetime
+import os
 import sqlite3
-from typing import List, Dict, Optional
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Iterator, Optional, Tuple
+from records import Patient, Visit, Message, HistoryEntry, UsageTotals, ChatTurn
+from compression import BodyCodec
+
+try:
+    from google.generativeai import caching
+except ImportError:
+    # Older SDKs ship without context caching; prompts are then sent in full
+    caching = None
+
+MODEL_NAME = 'gemini-2.5-flash'
+
+# Number of most recent archived visits included in the context prompt
+CONTEXT_VISIT_LIMIT = 5
+
+# Patients whose rendered prompt prefix is kept in memory (least recently used evicted)
+PROMPT_PREFIX_CACHE_SIZE = 256
+
+# Lifetime of a Gemini cached context holding a patient's prompt prefix
+CONTEXT_CACHE_TTL = datetime.timedelta(minutes=30)
+
+# Smallest prefix (in estimated tokens) worth a Gemini cached context; the
+# API rejects contexts below the model's minimum cacheable size
+CONTEXT_CACHE_MIN_TOKENS = 1024
+
+# Default age after which ended consultations move to the archive tier
+ARCHIVE_AFTER_DAYS = 365
+
+# Conversations moved to the archive per transaction
+ARCHIVE_BATCH_SIZE = 50
+
+# Quiet period after a chat turn before the background draft summary is refreshed
+SUMMARY_DEBOUNCE_SECONDS = 5.0
+
+# Gemini pricing in USD per million tokens, used for usage cost estimates;
+# update to match the current price list
+PRICE_PER_MILLION_INPUT = 0.30
+PRICE_PER_MILLION_CACHED_INPUT = 0.03
+PRICE_PER_MILLION_OUTPUT = 2.50
+
+# Rough characters per token for local estimates when a response carries no usage metadata
+CHARS_PER_TOKEN = 4
+
+# Model call types recorded in the usage table
+USAGE_CALL_TYPES = ("chat", "summary", "draft_summary")
+
+SUMMARY_FORMAT_INSTRUCTIONS = """Format your response EXACTLY as follows:
+    SUMMARY: [your summary here]
+    SYMPTOMS: [symptom1, symptom2, symptom3]
+    DIAGNOSES: [diagnosis1, diagnosis2, diagnosis3]
+    """
 
 class MedicalAssistantAgent:
     """
@@ -9,21 +64,64 @@ class MedicalAssistantAgent:
     Stores patient interactions and history in SQLite database
     """
     
-    def __init__(self, api_key: str, db_path: str = "medical_assistant.db"):
+    def __init__(self, api_key: str, db_path: str = "medical_assistant.db",
+                 context_caching: bool = True, background_summaries: bool = True,
+                 compression: Optional[str] = None, archive_path: Optional[str] = None):
         """
         Initialize the Medical Assistant Agent
         
         Args:
             api_key: Google AI API key for Gemini
             db_path: Path to SQLite database file
+            context_caching: Use Gemini context caching for per-patient prompt prefixes
+            background_summaries: Keep a draft consultation summary up to date after each turn
+            compression: Store large message/summary bodies compressed ('zlib' or 'zstd')
+            archive_path: SQLite file holding archived messages
+                          (defaults to <db name>_archive.db next to db_path)
         """
         # Configure Gemini API
         genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
+        self.model = genai.GenerativeModel(MODEL_NAME)
         
         # Database setup
         self.db_path = db_path
+        self.archive_path = archive_path or os.path.splitext(db_path)[0] + "_archive.db"
         self.init_database()
+        if os.path.exists(self.archive_path):
+            self.init_archive_database()
+        
+        # Codec for large bodies; compressed rows are always readable, whatever
+        # the method used for new writes
+        self.codec = BodyCodec(compression,
+                               dictionaries=self.load_compression_dictionaries(),
+                               load_dictionary=self.load_compression_dictionary)
+        
+        # Prompt prefix caches: rendered prefix per patient, and Gemini cached
+        # contexts keyed by patient (None when caching is unavailable)
+        self.context_caching = context_caching and caching is not None
+        self._prompt_prefixes: OrderedDict = OrderedDict()
+        self._context_caches: Dict[str, Dict] = {}
+        # Prefix per patient that Gemini refused to cache
+        self._uncacheable_prefixes: OrderedDict = OrderedDict()
+        # Bumped on invalidation (per patient, or the epoch for everyone) so a
+        # prefix built from stale data is not stored
+        self._context_versions: Dict[str, int] = {}
+        self._context_epoch = 0
+        self._prefetching = set()
+        # Patients whose Gemini cached context is being created
+        self._creating_caches = set()
+        # Guards the caches above; the GUI calls the agent from worker threads.
+        # Only held to read and update them, never across API calls
+        self._cache_lock = threading.RLock()
+        
+        # Speculative consultation summaries: draft per conversation (covering
+        # messages up to its last_message_id), debounce timers and a generation
+        # counter that supersedes refreshes scheduled for older turns
+        self.background_summaries = background_summaries
+        self._summary_drafts: Dict[int, Dict] = {}
+        self._summary_timers: Dict[int, threading.Timer] = {}
+        self._summary_generations: Dict[int, int] = {}
+        self._summary_lock = threading.Lock()
         
         # System instructions
         self.system_instructions = """You are a medical assistant working with doctors to help diagnose and monitor patients.
@@ -54,6 +152,10 @@ When analyzing symptoms:
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
+        # WAL lets readers (e.g. a snapshot in progress) keep a consistent view
+        # without blocking writers
+        cursor.execute("PRAGMA journal_mode=WAL")
+        
         # Patients table
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS patients (
@@ -103,8 +205,174 @@ When analyzing symptoms:
             )
         """)
         
+        # Keyset pagination over a conversation's messages in insertion order
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_messages_conversation
+            ON messages (conversation_id, message_id)
+        """)
+        
+        # A patient's latest visits, for the rolling summary
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_conversations_patient
+            ON conversations (patient_id, session_date, conversation_id)
+        """)
+        
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_patient_history_conversation
+            ON patient_history (conversation_id)
+        """)
+        
+        # Rolling per-patient digest of archived visits used for context building
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS patient_summaries (
+                patient_id TEXT PRIMARY KEY,
+                visit_count INTEGER DEFAULT 0,
+                visits_text TEXT DEFAULT '',
+                visits_encoding TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (patient_id) REFERENCES patients (patient_id)
+            )
+        """)
+        
+        # Shared zstd dictionaries for compressed bodies
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS compression_dictionaries (
+                dict_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                data BLOB,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Token usage per model call; estimated = 1 when the counts were
+        # approximated locally instead of reported by the API
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS usage (
+                usage_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                conversation_id INTEGER,
+                patient_id TEXT,
+                call_type TEXT NOT NULL,
+                prompt_tokens INTEGER DEFAULT 0,
+                cached_tokens INTEGER DEFAULT 0,
+                output_tokens INTEGER DEFAULT 0,
+                total_tokens INTEGER DEFAULT 0,
+                estimated INTEGER DEFAULT 0,
+                latency_ms REAL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (conversation_id) REFERENCES conversations (conversation_id)
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_usage_conversation
+            ON usage (conversation_id)
+        """)
+        
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_usage_patient
+            ON usage (patient_id)
+        """)
+        
+        # Columns added after a table's original schema
+        self.add_missing_column(cursor, "messages", "content_encoding", "TEXT")
+        self.add_missing_column(cursor, "patient_summaries", "visits_encoding", "TEXT")
+        self.add_missing_column(cursor, "conversations", "archived", "INTEGER DEFAULT 0")
+        
+        conn.commit()
+        conn.close()
+    
+    def init_archive_database(self):
+        """Create the archive database holding messages of archived conversations"""
+        conn = sqlite3.connect(self.archive_path)
+        cursor = conn.cursor()
+        
+        cursor.execute("PRAGMA journal_mode=WAL")
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                message_id INTEGER PRIMARY KEY,
+                conversation_id INTEGER,
+                role TEXT,
+                content TEXT,
+                timestamp TIMESTAMP,
+                content_encoding TEXT
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_messages_conversation
+            ON messages (conversation_id, message_id)
+        """)
+        
+        conn.commit()
+        conn.close()
+    
+    def connect_with_archive(self) -> sqlite3.Connection:
+        """Open the main database with the archive attached as 'archive', if it exists"""
+        conn = sqlite3.connect(self.db_path)
+        if os.path.exists(self.archive_path):
+            conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        return conn
+    
+    def archive_attached(self, cursor) -> bool:
+        """Whether the archive database is attached to the cursor's connection"""
+        cursor.execute("PRAGMA database_list")
+        return "archive" in [row[1] for row in cursor.fetchall()]
+    
+    def messages_table(self, cursor, conversation_id: int, include_archive: bool) -> str:
+        """
+        Name the table holding a conversation's messages
+        
+        Archived conversations are only read from the archive when explicitly
+        requested (and the cursor has it attached); otherwise the hot table is used.
+        """
+        if not include_archive or not self.archive_attached(cursor):
+            return "messages"
+        
+        cursor.execute("""
+            SELECT archived FROM conversations WHERE conversation_id = ?
+        """, (conversation_id,))
+        result = cursor.fetchone()
+        return "archive.messages" if result and result[0] else "messages"
+    
+    def add_missing_column(self, cursor, table: str, column: str, definition: str):
+        """Add a column to an existing table if it is not there yet"""
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    
+    def load_compression_dictionaries(self) -> Dict[int, bytes]:
+        """Load every stored zstd dictionary"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT dict_id, data FROM compression_dictionaries")
+        dictionaries = dict(cursor.fetchall())
+        conn.close()
+        return dictionaries
+    
+    def load_compression_dictionary(self, dict_id: int) -> Optional[bytes]:
+        """Load one zstd dictionary, e.g. one trained after this agent started"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT data FROM compression_dictionaries WHERE dict_id = ?", (dict_id,))
+        result = cursor.fetchone()
+        conn.close()
+        return result[0] if result else None
+    
+    def save_compression_dictionary(self, data: bytes) -> int:
+        """Store a trained zstd dictionary and use it for new writes"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO compression_dictionaries (data) VALUES (?)", (data,))
+        dict_id = cursor.lastrowid
         conn.commit()
         conn.close()
+        
+        self.codec.add_dictionary(dict_id, data)
+        return dict_id
+    
+    def message_row_factory(self, cursor, row) -> Message:
+        """Build a Message from (message_id, role, content, timestamp, content_encoding)"""
+        return Message(row[0], row[1], self.codec.decode(row[2], row[4]), row[3])
     
     def register_patient(self, patient_id: str, name: str, age: int, gender: str):
         """Register a new patient in the system"""
@@ -124,33 +392,27 @@ When analyzing symptoms:
         finally:
             conn.close()
     
-    def get_patient_info(self, patient_id: str) -> Optional[Dict]:
+    def get_patient_info(self, patient_id: str) -> Optional[Patient]:
         """Retrieve patient information"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
+        cursor.row_factory = Patient.row_factory
         
         cursor.execute("""
             SELECT patient_id, name, age, gender, created_at
             FROM patients WHERE patient_id = ?
         """, (patient_id,))
         
-        result = cursor.fetchone()
+        patient = cursor.fetchone()
         conn.close()
         
-        if result:
-            return {
-                "patient_id": result[0],
-                "name": result[1],
-                "age": result[2],
-                "gender": result[3],
-                "created_at": result[4]
-            }
-        return None
+        return patient
     
-    def get_all_patients(self) -> List[Dict]:
+    def get_all_patients(self) -> List[Patient]:
         """Get list of all patients"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
+        cursor.row_factory = Patient.row_factory
         
         cursor.execute("""
             SELECT patient_id, name, age, gender
@@ -158,22 +420,37 @@ When analyzing symptoms:
             ORDER BY name
         """)
         
-        patients = []
-        for row in cursor.fetchall():
-            patients.append({
-                "patient_id": row[0],
-                "name": row[1],
-                "age": row[2],
-                "gender": row[3]
-            })
+        patients = cursor.fetchall()
         
         conn.close()
         return patients
     
-    def get_patient_history(self, patient_id: str, limit: int = 5) -> List[Dict]:
+    def search_patients(self, query: str, limit: int = 50) -> List[Patient]:
+        """Find patients whose name or ID contains query, ordered by name"""
+        pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.row_factory = Patient.row_factory
+        
+        cursor.execute("""
+            SELECT patient_id, name, age, gender
+            FROM patients
+            WHERE name LIKE ? ESCAPE '\\' OR patient_id LIKE ? ESCAPE '\\'
+            ORDER BY name
+            LIMIT ?
+        """, (pattern, pattern, limit))
+        
+        patients = cursor.fetchall()
+        
+        conn.close()
+        return patients
+    
+    def get_patient_history(self, patient_id: str, limit: int = CONTEXT_VISIT_LIMIT) -> List[HistoryEntry]:
         """Retrieve patient's previous visits and symptoms"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
+        cursor.row_factory = HistoryEntry.row_factory
         
         cursor.execute("""
             SELECT 
@@ -185,19 +462,11 @@ When analyzing symptoms:
             FROM conversations c
             LEFT JOIN patient_history ph ON c.conversation_id = ph.conversation_id
             WHERE c.patient_id = ?
-            ORDER BY c.session_date ASC
+            ORDER BY c.session_date ASC, c.conversation_id ASC
             LIMIT ?
         """, (patient_id, limit))
         
-        history = []
-        for row in cursor.fetchall():
-            history.append({
-                "session_date": row[0],
-                "chief_complaint": row[1],
-                "summary": row[2],
-                "symptoms": row[3],
-                "diagnoses_considered": row[4]
-            })
+        history = cursor.fetchall()
         
         conn.close()
         return history
@@ -218,53 +487,497 @@ When analyzing symptoms:
         
         return conversation_id
     
-    def save_message(self, conversation_id: int, role: str, content: str):
-        """Save a message to the database"""
+    def save_message(self, conversation_id: int, role: str, content: str) -> int:
+        """Save a message to the database and return its message_id"""
+        content, encoding = self.codec.encode(content)
+        
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute("""
-            INSERT INTO messages (conversation_id, role, content)
-            VALUES (?, ?, ?)
-        """, (conversation_id, role, content))
+            INSERT INTO messages (conversation_id, role, content, content_encoding)
+            VALUES (?, ?, ?, ?)
+        """, (conversation_id, role, content, encoding))
+        message_id = cursor.lastrowid
         
         conn.commit()
         conn.close()
+        return message_id
     
-    def build_context_prompt(self, patient_id: str, current_message: str) -> str:
-        """Build a context-aware prompt with patient history"""
-        patient_info = self.get_patient_info(patient_id)
-        patient_history = self.get_patient_history(patient_id)
-        
-        context = f"{self.system_instructions}\n\n"
-        context += "=== PATIENT INFORMATION ===\n"
-        
-        if patient_info:
-            context += f"Patient ID: {patient_info['patient_id']}\n"
-            context += f"Name: {patient_info['name']}\n"
-            context += f"Age: {patient_info['age']}\n"
-            context += f"Gender: {patient_info['gender']}\n\n"
-        
-        if patient_history:
-            context += "=== PREVIOUS VISITS ===\n"
-            for i, visit in enumerate(patient_history, 1):
-                context += f"\nVisit {i} ({visit['session_date']}):\n"
-                context += f"Chief Complaint: {visit['chief_complaint']}\n"
-                if visit['symptoms']:
-                    context += f"Symptoms: {visit['symptoms']}\n"
-                if visit['diagnoses_considered']:
-                    context += f"Differential Diagnoses: {visit['diagnoses_considered']}\n"
-                if visit['summary']:
-                    context += f"Summary: {visit['summary']}\n"
+    def get_conversation_messages(self, conversation_id: int,
+                                  before_message_id: Optional[int] = None,
+                                  limit: int = 50,
+                                  include_archive: bool = False) -> List[Message]:
+        """
+        Retrieve a page of messages from a conversation, oldest first
+        
+        Pages backwards from before_message_id (or from the newest message when
+        None), using message_id as a keyset cursor. Messages of archived
+        conversations are only returned when include_archive is True.
+        """
+        conn = self.connect_with_archive() if include_archive else sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        table = self.messages_table(cursor, conversation_id, include_archive)
+        cursor.row_factory = self.message_row_factory
+        
+        if before_message_id is None:
+            cursor.execute(f"""
+                SELECT message_id, role, content, timestamp, content_encoding
+                FROM {table}
+                WHERE conversation_id = ?
+                ORDER BY message_id DESC
+                LIMIT ?
+            """, (conversation_id, limit))
+        else:
+            cursor.execute(f"""
+                SELECT message_id, role, content, timestamp, content_encoding
+                FROM {table}
+                WHERE conversation_id = ? AND message_id < ?
+                ORDER BY message_id DESC
+                LIMIT ?
+            """, (conversation_id, before_message_id, limit))
+        
+        messages = cursor.fetchall()
+        messages.reverse()
+        
+        conn.close()
+        return messages
+    
+    def iter_conversation_messages(self, conversation_id: int,
+                                   after_message_id: int = 0,
+                                   page_size: int = 200,
+                                   include_archive: bool = False) -> Iterator[Message]:
+        """
+        Stream a conversation's messages in order, oldest first
+        
+        Messages after after_message_id are fetched in pages of page_size
+        using message_id as a keyset cursor, so long transcripts never need
+        an OFFSET scan. Messages of archived conversations are only returned
+        when include_archive is True.
+        """
+        last_message_id = after_message_id
+        while True:
+            conn = self.connect_with_archive() if include_archive else sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            table = self.messages_table(cursor, conversation_id, include_archive)
+            cursor.row_factory = self.message_row_factory
+            
+            cursor.execute(f"""
+                SELECT message_id, role, content, timestamp, content_encoding
+                FROM {table}
+                WHERE conversation_id = ? AND message_id > ?
+                ORDER BY message_id ASC
+                LIMIT ?
+            """, (conversation_id, last_message_id, page_size))
+            
+            rows = cursor.fetchall()
+            conn.close()
+            
+            yield from rows
+            
+            if len(rows) < page_size:
+                return
+            last_message_id = rows[-1].message_id
+    
+    def get_patient_conversations(self, patient_id: str) -> List[Visit]:
+        """List a patient's consultations, most recent first"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.row_factory = Visit.row_factory
+        
+        cursor.execute("""
+            SELECT conversation_id, session_date, chief_complaint, summary
+            FROM conversations
+            WHERE patient_id = ?
+            ORDER BY session_date DESC, conversation_id DESC
+        """, (patient_id,))
+        
+        conversations = cursor.fetchall()
+        
+        conn.close()
+        return conversations
+    
+    def format_visit(self, index: int, visit: HistoryEntry) -> str:
+        """Render a single archived visit for the context prompt"""
+        text = f"\nVisit {index} ({visit.session_date}):\n"
+        text += f"Chief Complaint: {visit.chief_complaint}\n"
+        if visit.symptoms:
+            text += f"Symptoms: {visit.symptoms}\n"
+        if visit.diagnoses_considered:
+            text += f"Differential Diagnoses: {visit.diagnoses_considered}\n"
+        if visit.summary:
+            text += f"Summary: {visit.summary}\n"
+        return text
+    
+    def rebuild_patient_summary(self, patient_id: str) -> str:
+        """Recompute a patient's longitudinal summary from their archived visits"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            visits_text = self._rebuild_patient_summary(cursor, patient_id)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return visits_text
+    
+    def _rebuild_patient_summary(self, cursor, patient_id: str) -> str:
+        """Recompute and store a patient's summary using the caller's transaction"""
+        visits_text, visit_count = self._build_visits_text(cursor, patient_id)
+        
+        stored_text, encoding = self.codec.encode(visits_text)
+        cursor.execute("""
+            INSERT OR REPLACE INTO patient_summaries
+            (patient_id, visit_count, visits_text, visits_encoding)
+            VALUES (?, ?, ?, ?)
+        """, (patient_id, visit_count, stored_text, encoding))
+        return visits_text
+    
+    def _build_visits_text(self, cursor, patient_id: str) -> Tuple[str, int]:
+        """Render a patient's latest CONTEXT_VISIT_LIMIT visits, oldest first"""
+        cursor.execute("""
+            SELECT 
+                c.session_date,
+                c.chief_complaint,
+                c.summary,
+                ph.symptoms,
+                ph.diagnoses_considered
+            FROM conversations c
+            JOIN patient_history ph ON c.conversation_id = ph.conversation_id
+            WHERE c.patient_id = ?
+            ORDER BY c.session_date DESC, c.conversation_id DESC
+            LIMIT ?
+        """, (patient_id, CONTEXT_VISIT_LIMIT))
+        
+        visits_text = ""
+        rows = cursor.fetchall()[::-1]
+        for i, row in enumerate(rows, 1):
+            visits_text += self.format_visit(i, HistoryEntry(*row))
+        return visits_text, len(rows)
+    
+    def update_patient_summary(self, patient_id: str, conversation_id: int):
+        """Merge a newly archived visit into the patient's longitudinal summary"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        # Take the write lock before reading, so consultations of the same
+        # patient ending concurrently cannot overwrite each other's visit
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            self._merge_visit(cursor, patient_id, conversation_id)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+    
+    def _merge_visit(self, cursor, patient_id: str, conversation_id: int):
+        """
+        Add a visit to the stored summary using the caller's transaction
+        
+        The visit is appended when the digest has room and the visit is the
+        patient's latest. Otherwise (the digest is full, so the oldest visit
+        drops out, or a concurrent consultation started later ended first)
+        the latest CONTEXT_VISIT_LIMIT visits are re-read and renumbered, so
+        both paths produce the same digest.
+        """
+        cursor.execute("""
+            SELECT visit_count, visits_text, visits_encoding FROM patient_summaries
+            WHERE patient_id = ?
+        """, (patient_id,))
+        
+        row = cursor.fetchone()
+        if row is None or row[0] >= CONTEXT_VISIT_LIMIT:
+            self._rebuild_patient_summary(cursor, patient_id)
+            return
+        
+        visit_count, visits_text, encoding = row
+        
+        cursor.execute("""
+            SELECT 
+                c.session_date,
+                c.chief_complaint,
+                c.summary,
+                ph.symptoms,
+                ph.diagnoses_considered
+            FROM conversations c
+            JOIN patient_history ph ON c.conversation_id = ph.conversation_id
+            WHERE c.conversation_id = ?
+        """, (conversation_id,))
+        
+        visit = cursor.fetchone()
+        if visit:
+            cursor.execute("""
+                SELECT 1
+                FROM conversations c
+                JOIN patient_history ph ON c.conversation_id = ph.conversation_id
+                WHERE c.patient_id = ?
+                  AND (c.session_date > ? OR (c.session_date = ? AND c.conversation_id > ?))
+                LIMIT 1
+            """, (patient_id, visit[0], visit[0], conversation_id))
+            if cursor.fetchone():
+                self._rebuild_patient_summary(cursor, patient_id)
+                return
+            
+            visits_text = self.codec.decode(visits_text, encoding)
+            visits_text += self.format_visit(visit_count + 1, HistoryEntry(*visit))
+            stored_text, encoding = self.codec.encode(visits_text)
+            cursor.execute("""
+                UPDATE patient_summaries
+                SET visit_count = ?, visits_text = ?, visits_encoding = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE patient_id = ?
+            """, (visit_count + 1, stored_text, encoding, patient_id))
+    
+    def get_patient_summary(self, patient_id: str) -> Optional[Dict]:
+        """Retrieve patient information together with their precomputed visit summary"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            SELECT p.patient_id, p.name, p.age, p.gender, s.visits_text, s.visits_encoding
+            FROM patients p
+            LEFT JOIN patient_summaries s ON p.patient_id = s.patient_id
+            WHERE p.patient_id = ?
+        """, (patient_id,))
+        
+        result = cursor.fetchone()
+        if not result:
+            conn.close()
+            return None
+        
+        visits_text = result[4]
+        if visits_text is None:
+            # No digest yet (e.g. data predating the summary table): render it
+            # without writing; end_conversation stores it with the next visit
+            visits_text, _ = self._build_visits_text(cursor, patient_id)
         else:
-            context += "=== PREVIOUS VISITS ===\n"
-            context += "This is the patient's first visit.\n"
+            visits_text = self.codec.decode(visits_text, result[5])
+        conn.close()
+        
+        return {
+            "patient_id": result[0],
+            "name": result[1],
+            "age": result[2],
+            "gender": result[3],
+            "visits_text": visits_text
+        }
+    
+    def build_context_prefix(self, patient_id: str) -> str:
+        """
+        Build the stable part of the prompt (instructions + patient block)
+        
+        The prefix is byte-identical across turns for the same patient so it
+        can be served from the local template cache or a Gemini cached context.
+        """
+        with self._cache_lock:
+            prefix = self._prompt_prefixes.get(patient_id)
+            version = self._context_version(patient_id)
+            if prefix is not None:
+                self._prompt_prefixes.move_to_end(patient_id)
+        if prefix is not None:
+            return prefix
+        
+        patient_summary = self.get_patient_summary(patient_id)
+        
+        prefix = f"{self.system_instructions}\n\n"
+        prefix += "=== PATIENT INFORMATION ===\n"
+        
+        if patient_summary:
+            prefix += f"Patient ID: {patient_summary['patient_id']}\n"
+            prefix += f"Name: {patient_summary['name']}\n"
+            prefix += f"Age: {patient_summary['age']}\n"
+            prefix += f"Gender: {patient_summary['gender']}\n\n"
+        
+        prefix += "=== PREVIOUS VISITS ===\n"
+        if patient_summary and patient_summary['visits_text']:
+            prefix += patient_summary['visits_text']
+        else:
+            prefix += "This is the patient's first visit.\n"
+        
+        prefix += "\nPlease provide your analysis of the query below following the structured format outlined in your responsibilities.\n"
+        
+        with self._cache_lock:
+            if self._context_version(patient_id) == version:
+                self._remember(self._prompt_prefixes, patient_id, prefix)
+        return prefix
+    
+    def _context_version(self, patient_id: str) -> Tuple[int, int]:
+        """Version of a patient's cached context; call with _cache_lock held"""
+        return self._context_epoch, self._context_versions.get(patient_id, 0)
+    
+    def _remember(self, cache: OrderedDict, patient_id: str, value: str):
+        """Store a per-patient entry, evicting the least recently used past the limit"""
+        cache[patient_id] = value
+        cache.move_to_end(patient_id)
+        while len(cache) > PROMPT_PREFIX_CACHE_SIZE:
+            cache.popitem(last=False)
+    
+    def build_query_suffix(self, current_message: str, conversation_id: Optional[int] = None) -> str:
+        """
+        Build the volatile part of the prompt carrying the current query
+        
+        When conversation_id is given, the consultation's chief complaint is
+        included; the in-progress visit is not part of the cached prefix.
+        """
+        suffix = "\n=== CURRENT CONSULTATION ===\n"
+        if conversation_id is not None:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT chief_complaint FROM conversations
+                WHERE conversation_id = ?
+            """, (conversation_id,))
+            result = cursor.fetchone()
+            conn.close()
+            if result and result[0]:
+                suffix += f"Chief Complaint: {result[0]}\n"
+        suffix += f"Doctor/User Query: {current_message}\n"
+        return suffix
+    
+    def build_context_prompt(self, patient_id: str, current_message: str,
+                             conversation_id: Optional[int] = None) -> str:
+        """Build a context-aware prompt with patient history"""
+        return (self.build_context_prefix(patient_id) +
+                self.build_query_suffix(current_message, conversation_id))
+    
+    def prefetch_patient_context(self, patient_id: str):
+        """
+        Build a patient's prompt prefix on a background thread
+        
+        Called when a patient is selected (or hovered) so the first chat() turn
+        of the next consultation finds its prefix ready. Only the local cache
+        is warmed; Gemini cached contexts are billed and created by chat() alone.
+        """
+        with self._cache_lock:
+            if patient_id in self._prompt_prefixes or patient_id in self._prefetching:
+                return
+            self._prefetching.add(patient_id)
+        
+        def warm():
+            try:
+                self.build_context_prefix(patient_id)
+            except Exception:
+                # Prefetching is opportunistic; chat() rebuilds on a miss
+                pass
+            finally:
+                with self._cache_lock:
+                    self._prefetching.discard(patient_id)
+        
+        threading.Thread(target=warm, daemon=True).start()
+    
+    def invalidate_patient_context(self, patient_id: Optional[str] = None):
+        """Drop cached prompt prefixes for a patient (or every patient if None)"""
+        with self._cache_lock:
+            if patient_id is None:
+                # A new epoch also supersedes builds in flight for patients
+                # that have nothing cached yet
+                self._context_epoch += 1
+                self._context_versions.clear()
+                self._prompt_prefixes.clear()
+                self._uncacheable_prefixes.clear()
+                stale_entries = list(self._context_caches.values())
+                self._context_caches.clear()
+            else:
+                self._context_versions[patient_id] = self._context_versions.get(patient_id, 0) + 1
+                self._prompt_prefixes.pop(patient_id, None)
+                self._uncacheable_prefixes.pop(patient_id, None)
+                entry = self._context_caches.pop(patient_id, None)
+                stale_entries = [entry] if entry else []
         
-        context += f"\n=== CURRENT CONSULTATION ===\n"
-        context += f"Doctor/User Query: {current_message}\n\n"
-        context += "Please provide your analysis following the structured format outlined in your responsibilities."
+        for entry in stale_entries:
+            self._delete_cached_content(entry)
+    
+    def reset_caches(self):
+        """Drop every in-memory cache, e.g. after the database was restored from a backup"""
+        self.invalidate_patient_context()
+        with self._summary_lock:
+            conversation_ids = set(self._summary_drafts) | set(self._summary_timers)
+        for conversation_id in conversation_ids:
+            self.discard_draft_summary(conversation_id)
+        self.codec = BodyCodec(self.codec.method, self.codec.threshold,
+                               dictionaries=self.load_compression_dictionaries(),
+                               load_dictionary=self.load_compression_dictionary)
+    
+    def _delete_cached_content(self, entry: Dict):
+        """Best-effort removal of a Gemini cached context, on a background thread"""
+        def delete():
+            try:
+                entry['cache'].delete()
+            except Exception:
+                # The cache expires on its own after CONTEXT_CACHE_TTL
+                pass
         
-        return context
+        threading.Thread(target=delete, daemon=True).start()
+    
+    def _get_cached_model(self, patient_id: str, prefix: str):
+        """
+        Return a model bound to a Gemini cached context holding the prefix
+        
+        Returns None when caching is disabled or the prefix cannot be cached
+        (e.g. it is below the API's minimum cacheable size).
+        """
+        if not self.context_caching or self.estimate_tokens(prefix) < CONTEXT_CACHE_MIN_TOKENS:
+            return None
+        
+        with self._cache_lock:
+            if self._uncacheable_prefixes.get(patient_id) == prefix:
+                return None
+            
+            entry = self._context_caches.get(patient_id)
+            if entry and entry['prefix'] == prefix and entry['expires'] > datetime.datetime.now():
+                return entry['model']
+            if entry:
+                self._context_caches.pop(patient_id, None)
+            # Another thread is creating this patient's cache; send the full
+            # prompt meanwhile rather than waiting on the round-trip
+            creating = patient_id in self._creating_caches
+            if not creating:
+                self._creating_caches.add(patient_id)
+                version = self._context_version(patient_id)
+        
+        if entry:
+            self._delete_cached_content(entry)
+        if creating:
+            return None
+        
+        try:
+            cache = caching.CachedContent.create(
+                model=f"models/{MODEL_NAME}",
+                display_name=f"patient-{patient_id}",
+                contents=[prefix],
+                ttl=CONTEXT_CACHE_TTL
+            )
+            model = genai.GenerativeModel.from_cached_content(cached_content=cache)
+        except Exception:
+            with self._cache_lock:
+                self._creating_caches.discard(patient_id)
+                self._remember(self._uncacheable_prefixes, patient_id, prefix)
+            return None
+        
+        # Refresh a minute early so a request never races the server-side expiry
+        entry = {
+            "prefix": prefix,
+            "cache": cache,
+            "model": model,
+            "expires": datetime.datetime.now() + CONTEXT_CACHE_TTL - datetime.timedelta(minutes=1)
+        }
+        with self._cache_lock:
+            self._creating_caches.discard(patient_id)
+            current = self._context_version(patient_id) == version
+            if current:
+                self._context_caches[patient_id] = entry
+        
+        if not current:
+            # The patient's context was invalidated while the cache was created
+            self._delete_cached_content(entry)
+            return None
+        return model
     
     def chat(self, patient_id: str, conversation_id: int, user_message: str) -> str:
         """
@@ -278,49 +991,90 @@ When analyzing symptoms:
         Returns:
             AI assistant response
         """
-        # Build context-aware prompt
-        full_prompt = self.build_context_prompt(patient_id, user_message)
+        return self.chat_turn(patient_id, conversation_id, user_message).response
+    
+    def chat_turn(self, patient_id: str, conversation_id: int, user_message: str) -> ChatTurn:
+        """Like chat(), also returning the message_ids of the stored query and response"""
+        # Build context-aware prompt: stable per-patient prefix + current query
+        prefix = self.build_context_prefix(patient_id)
+        suffix = self.build_query_suffix(user_message, conversation_id)
         
         # Save user message
-        self.save_message(conversation_id, "user", user_message)
+        user_message_id = self.save_message(conversation_id, "user", user_message)
         
-        # Get AI response
-        response = self.model.generate_content(full_prompt)
+        # Get AI response, sending only the query when the prefix is cached server-side
+        cached_model = self._get_cached_model(patient_id, prefix)
+        response = None
+        if cached_model is not None:
+            try:
+                start = time.perf_counter()
+                response = cached_model.generate_content(suffix)
+                sent, cached = suffix, prefix
+            except Exception:
+                self.invalidate_patient_context(patient_id)
+        if response is None:
+            start = time.perf_counter()
+            response = self.model.generate_content(prefix + suffix)
+            sent, cached = prefix + suffix, ""
+        latency = time.perf_counter() - start
         ai_response = response.text
         
         # Save AI response
-        self.save_message(conversation_id, "assistant", ai_response)
+        response_message_id = self.save_message(conversation_id, "assistant", ai_response)
+        self.record_usage(conversation_id, "chat", response, sent, ai_response,
+                          cached_text=cached, latency=latency)
         
-        return ai_response
+        if self.background_summaries:
+            self.schedule_draft_summary(conversation_id)
+        
+        return ChatTurn(ai_response, user_message_id, response_message_id)
     
     def end_conversation(self, conversation_id: int, summary: str, 
                         symptoms: str, diagnoses: str):
         """
         End a conversation and save summary to patient history
+        
+        The summary, the history entry and the patient summary update are
+        written in one transaction, so a failed save can simply be retried.
         """
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
-        # Update conversation with summary
-        cursor.execute("""
-            UPDATE conversations
-            SET summary = ?
-            WHERE conversation_id = ?
-        """, (summary, conversation_id))
-        
-        # Get patient_id for this conversation
-        cursor.execute("""
-            SELECT patient_id FROM conversations
-            WHERE conversation_id = ?
-        """, (conversation_id,))
-        
-        patient_id = cursor.fetchone()[0]
-        conn.commit()
-        conn.close()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # Update conversation with summary
+            cursor.execute("""
+                UPDATE conversations
+                SET summary = ?
+                WHERE conversation_id = ?
+            """, (summary, conversation_id))
+            
+            # Get patient_id for this conversation
+            cursor.execute("""
+                SELECT patient_id FROM conversations
+                WHERE conversation_id = ?
+            """, (conversation_id,))
+            
+            patient_id = cursor.fetchone()[0]
+            
+            # Save to patient history
+            cursor.execute("""
+                INSERT INTO patient_history 
+                (patient_id, conversation_id, symptoms, diagnoses_considered)
+                VALUES (?, ?, ?, ?)
+            """, (patient_id, conversation_id, symptoms, diagnoses))
+            
+            # Fold the new visit into the patient's longitudinal summary
+            self._merge_visit(cursor, patient_id, conversation_id)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
         
-        # Save to patient history
-        self.save_patient_history_entry(patient_id, conversation_id, 
-                                       symptoms, diagnoses)
+        self.invalidate_patient_context(patient_id)
+        self.discard_draft_summary(conversation_id)
     
     def save_patient_history_entry(self, patient_id: str, conversation_id: int, 
                                    symptoms: str, diagnoses_considered: str):
@@ -337,47 +1091,113 @@ When analyzing symptoms:
         conn.commit()
         conn.close()
 
-    def generate_consultation_summary(self, conversation_id: int) -> Dict[str, str]:
+    def schedule_draft_summary(self, conversation_id: int):
         """
-        Generate automated summary, symptoms, and diagnoses from conversation
+        (Re)start the debounce timer for a conversation's background draft summary
         
-        Returns:
-            Dict with 'summary', 'symptoms', and 'diagnoses' keys
+        A newer turn cancels the pending timer and supersedes any refresh that
+        has not yet reached the model.
         """
-        # Get all messages from the conversation
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._summary_lock:
+            timer = self._summary_timers.pop(conversation_id, None)
+            if timer:
+                timer.cancel()
+            generation = self._summary_generations.get(conversation_id, 0) + 1
+            self._summary_generations[conversation_id] = generation
+            
+            timer = threading.Timer(SUMMARY_DEBOUNCE_SECONDS, self._refresh_draft_summary,
+                                    args=(conversation_id, generation))
+            timer.daemon = True
+            self._summary_timers[conversation_id] = timer
+            timer.start()
+    
+    def _refresh_draft_summary(self, conversation_id: int, generation: int):
+        """Fold the turns since the last draft into a new draft summary"""
+        with self._summary_lock:
+            if self._summary_generations.get(conversation_id) != generation:
+                return
+            self._summary_timers.pop(conversation_id, None)
         
-        cursor.execute("""
-            SELECT role, content
-            FROM messages
-            WHERE conversation_id = ?
-            ORDER BY timestamp ASC
-        """, (conversation_id,))
+        try:
+            self._summarize_conversation(conversation_id, "draft_summary")
+        except Exception:
+            # Drafts are best-effort; generate_consultation_summary falls back
+            # to summarizing whatever the draft does not cover
+            pass
+    
+    def get_draft_summary(self, conversation_id: int) -> Optional[Dict]:
+        """
+        Return the latest background draft summary for a conversation, if any
         
-        messages = cursor.fetchall()
+        The draft has 'summary', 'symptoms' and 'diagnoses' keys plus
+        'last_message_id', the newest message it covers.
+        """
+        with self._summary_lock:
+            draft = self._summary_drafts.get(conversation_id)
+            return dict(draft) if draft else None
+    
+    def discard_draft_summary(self, conversation_id: int):
+        """Cancel background summarization and drop the draft for a conversation"""
+        with self._summary_lock:
+            timer = self._summary_timers.pop(conversation_id, None)
+            if timer:
+                timer.cancel()
+            self._summary_drafts.pop(conversation_id, None)
+            self._summary_generations.pop(conversation_id, None)
+    
+    def _summarize_conversation(self, conversation_id: int, call_type: str = "summary") -> Dict:
+        """
+        Bring the conversation's draft summary up to date and return it
         
-        # Get patient_id and chief_complaint
+        Only the messages newer than the current draft are sent to the model,
+        together with the draft itself. Raises if the model call fails.
+        call_type is the usage category recorded for the model call.
+        """
+        draft = self.get_draft_summary(conversation_id)
+        after_message_id = draft['last_message_id'] if draft else 0
+        new_messages = list(self.iter_conversation_messages(conversation_id, after_message_id))
+        if draft and not new_messages:
+            return draft
+        
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        # Get chief_complaint
         cursor.execute("""
-            SELECT patient_id, chief_complaint
+            SELECT chief_complaint
             FROM conversations
             WHERE conversation_id = ?
         """, (conversation_id,))
         
-        result = cursor.fetchone()
-        patient_id = result[0]
-        chief_complaint = result[1]
-        
+        chief_complaint = cursor.fetchone()[0]
         conn.close()
         
         # Build conversation transcript
         transcript = f"Chief Complaint: {chief_complaint}\n\n"
-        transcript += "Conversation:\n"
-        for role, content in messages:
-            transcript += f"{role.upper()}: {content}\n\n"
+        transcript += "Conversation:\n" if not draft else "New messages:\n"
+        for message in new_messages:
+            transcript += f"{message.role.upper()}: {message.content}\n\n"
         
-        # Create summarization prompt
-        summary_prompt = f"""Based on the following medical consultation, provide a structured summary:
+        if draft:
+            # Fold the new turns into the running summary
+            summary_prompt = f"""Below is the running summary of a medical consultation, followed by the messages exchanged since it was written:
+
+    SUMMARY: {draft['summary']}
+    SYMPTOMS: {draft['symptoms']}
+    DIAGNOSES: {draft['diagnoses']}
+
+    {transcript}
+
+    Update the summary so that it covers the entire consultation, in a concise manner:
+
+    1. CONSULTATION SUMMARY (2-3 sentences summarizing the entire consultation)
+    2. KEY SYMPTOMS (comma-separated list of main symptoms discussed)
+    3. DIFFERENTIAL DIAGNOSES (comma-separated list of conditions considered)
+
+    {SUMMARY_FORMAT_INSTRUCTIONS}"""
+        else:
+            # Create summarization prompt
+            summary_prompt = f"""Based on the following medical consultation, provide a structured summary:
 
     {transcript}
 
@@ -387,66 +1207,307 @@ When analyzing symptoms:
     2. KEY SYMPTOMS (comma-separated list of main symptoms discussed)
     3. DIFFERENTIAL DIAGNOSES (comma-separated list of conditions considered)
 
-    Format your response EXACTLY as follows:
-    SUMMARY: [your summary here]
-    SYMPTOMS: [symptom1, symptom2, symptom3]
-    DIAGNOSES: [diagnosis1, diagnosis2, diagnosis3]
-    """
+    {SUMMARY_FORMAT_INSTRUCTIONS}"""
+        
+        start = time.perf_counter()
+        response = self.model.generate_content(summary_prompt)
+        latency = time.perf_counter() - start
+        summary_text = response.text
+        self.record_usage(conversation_id, call_type, response, summary_prompt, summary_text,
+                          latency=latency)
+        
+        # Parse the response
+        summary = ""
+        symptoms = ""
+        diagnoses = ""
+        
+        lines = summary_text.strip().split('\n')
+        for line in lines:
+            line = line.strip()
+            if line.startswith('SUMMARY:'):
+                summary = line.replace('SUMMARY:', '').strip()
+            elif line.startswith('SYMPTOMS:'):
+                symptoms = line.replace('SYMPTOMS:', '').strip()
+            elif line.startswith('DIAGNOSES:'):
+                diagnoses = line.replace('DIAGNOSES:', '').strip()
+        
+        # Fallback if parsing fails
+        if not summary:
+            summary = "Consultation completed. See conversation history for details."
+        if not symptoms:
+            symptoms = chief_complaint
+        if not diagnoses:
+            diagnoses = "Under evaluation"
+        
+        draft = {
+            'summary': summary,
+            'symptoms': symptoms,
+            'diagnoses': diagnoses,
+            'last_message_id': new_messages[-1].message_id if new_messages else after_message_id
+        }
+        
+        # Keep whichever draft covers more of the conversation; a slower
+        # refresh may finish after a newer one. A refresh finishing after
+        # discard_draft_summary (which drops the generation) stores nothing
+        with self._summary_lock:
+            if conversation_id not in self._summary_generations:
+                return draft
+            current = self._summary_drafts.get(conversation_id)
+            if current is None or current['last_message_id'] <= draft['last_message_id']:
+                self._summary_drafts[conversation_id] = draft
+        
+        return draft
+
+    def generate_consultation_summary(self, conversation_id: int) -> Dict[str, str]:
+        """
+        Generate automated summary, symptoms, and diagnoses from conversation
+        
+        Reuses the background draft summary when one exists, so at most the
+        turns since the last draft need to be folded in.
+        
+        Returns:
+            Dict with 'summary', 'symptoms', and 'diagnoses' keys
+        """
+        # The final summary supersedes any pending background refresh
+        with self._summary_lock:
+            timer = self._summary_timers.pop(conversation_id, None)
+            if timer:
+                timer.cancel()
+            self._summary_generations[conversation_id] = self._summary_generations.get(conversation_id, 0) + 1
         
-        # Get AI summary
         try:
-            response = self.model.generate_content(summary_prompt)
-            summary_text = response.text
-            
-            # Parse the response
-            summary = ""
-            symptoms = ""
-            diagnoses = ""
-            
-            lines = summary_text.strip().split('\n')
-            for line in lines:
-                if line.startswith('SUMMARY:'):
-                    summary = line.replace('SUMMARY:', '').strip()
-                elif line.startswith('SYMPTOMS:'):
-                    symptoms = line.replace('SYMPTOMS:', '').strip()
-                elif line.startswith('DIAGNOSES:'):
-                    diagnoses = line.replace('DIAGNOSES:', '').strip()
-            
-            # Fallback if parsing fails
-            if not summary:
-                summary = "Consultation completed. See conversation history for details."
-            if not symptoms:
-                symptoms = chief_complaint
-            if not diagnoses:
-                diagnoses = "Under evaluation"
-            
+            draft = self._summarize_conversation(conversation_id)
             return {
-                'summary': summary,
-                'symptoms': symptoms,
-                'diagnoses': diagnoses
+                'summary': draft['summary'],
+                'symptoms': draft['symptoms'],
+                'diagnoses': draft['diagnoses']
             }
             
         except Exception as e:
+            # Fall back to the draft covering the earlier turns, if any
+            draft = self.get_draft_summary(conversation_id)
+            if draft:
+                return {
+                    'summary': draft['summary'],
+                    'symptoms': draft['symptoms'],
+                    'diagnoses': draft['diagnoses']
+                }
+            
             # Fallback summary if AI fails
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT chief_complaint FROM conversations
+                WHERE conversation_id = ?
+            """, (conversation_id,))
+            chief_complaint = cursor.fetchone()[0]
+            conn.close()
+            
             return {
                 'summary': f"Consultation regarding: {chief_complaint}",
                 'symptoms': chief_complaint,
                 'diagnoses': "Pending further evaluation"
             }
         
-    def clear_all_data(self):
-        """Clear all data from all tables (WARNING: Irreversible!)"""
+    def estimate_tokens(self, text: str) -> int:
+        """Approximate token count of a text, for responses without usage metadata"""
+        if not text:
+            return 0
+        return max(len(text) // CHARS_PER_TOKEN, 1)
+    
+    def record_usage(self, conversation_id: int, call_type: str, response,
+                     prompt_text: str, output_text: str, cached_text: str = "",
+                     latency: Optional[float] = None):
+        """
+        Store the token usage of one model call
+        
+        Counts come from the response's usage_metadata. When it is missing
+        (e.g. a local stub model), they are estimated from the prompt and
+        output text and the row is flagged as estimated.
+        
+        Args:
+            conversation_id: Conversation the call belongs to
+            call_type: One of USAGE_CALL_TYPES
+            response: Model response
+            prompt_text: Prompt sent with the call
+            output_text: Text of the response
+            cached_text: Part of the prompt served from a cached context
+            latency: Duration of the call in seconds
+        """
+        if call_type not in USAGE_CALL_TYPES:
+            raise ValueError(f"Unknown usage call type: {call_type}")
+        
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None and getattr(usage, "prompt_token_count", None):
+            prompt_tokens = usage.prompt_token_count
+            cached_tokens = getattr(usage, "cached_content_token_count", 0) or 0
+            # Thinking tokens are billed as output
+            output_tokens = ((getattr(usage, "candidates_token_count", 0) or 0) +
+                             (getattr(usage, "thoughts_token_count", 0) or 0))
+            total_tokens = getattr(usage, "total_token_count", 0) or prompt_tokens + output_tokens
+            estimated = 0
+        else:
+            cached_tokens = self.estimate_tokens(cached_text)
+            prompt_tokens = cached_tokens + self.estimate_tokens(prompt_text)
+            output_tokens = self.estimate_tokens(output_text)
+            total_tokens = prompt_tokens + output_tokens
+            estimated = 1
+        
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
+        cursor.execute("""
+            INSERT INTO usage
+            (conversation_id, patient_id, call_type, prompt_tokens, cached_tokens,
+             output_tokens, total_tokens, estimated, latency_ms)
+            VALUES (?, (SELECT patient_id FROM conversations WHERE conversation_id = ?),
+                    ?, ?, ?, ?, ?, ?, ?)
+        """, (conversation_id, conversation_id, call_type, prompt_tokens, cached_tokens,
+              output_tokens, total_tokens, estimated,
+              latency * 1000 if latency is not None else None))
+        
+        conn.commit()
+        conn.close()
+    
+    def get_usage_report(self, group_by: str = "patient", patient_id: Optional[str] = None,
+                         limit: Optional[int] = None) -> List[UsageTotals]:
+        """
+        Aggregate recorded token usage, largest total first
+        
+        Args:
+            group_by: 'patient', 'conversation' or 'call_type'
+            patient_id: Only include calls for this patient
+            limit: Maximum number of rows
+            
+        Returns:
+            UsageTotals records; key is the patient id, conversation id or
+            call type and label a human-readable name for it. cost is in USD.
+        """
+        groupings = {
+            "patient": ("u.patient_id", "COALESCE(p.name, u.patient_id)"),
+            "conversation": ("u.conversation_id",
+                             "COALESCE(p.name, u.patient_id) || ' - ' || COALESCE(c.chief_complaint, '')"),
+            "call_type": ("u.call_type", "u.call_type"),
+        }
+        if group_by not in groupings:
+            raise ValueError(f"Unknown usage grouping: {group_by}")
+        key, label = groupings[group_by]
+        
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = UsageTotals.row_factory
+        cursor = conn.cursor()
+        
+        query = f"""
+            SELECT {key}, {label}, COUNT(*),
+                   SUM(u.prompt_tokens), SUM(u.cached_tokens), SUM(u.output_tokens),
+                   SUM(u.total_tokens), AVG(u.prompt_tokens), AVG(u.latency_ms),
+                   SUM(u.estimated),
+                   (SUM(u.prompt_tokens - u.cached_tokens) * ? + SUM(u.cached_tokens) * ?
+                    + SUM(u.output_tokens) * ?) / 1000000.0
+            FROM usage u
+            LEFT JOIN conversations c ON u.conversation_id = c.conversation_id
+            LEFT JOIN patients p ON u.patient_id = p.patient_id
+        """
+        params = [PRICE_PER_MILLION_INPUT, PRICE_PER_MILLION_CACHED_INPUT, PRICE_PER_MILLION_OUTPUT]
+        if patient_id is not None:
+            query += " WHERE u.patient_id = ?"
+            params.append(patient_id)
+        query += f" GROUP BY {key} ORDER BY SUM(u.total_tokens) DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        
+        cursor.execute(query, params)
+        totals = cursor.fetchall()
+        conn.close()
+        return totals
+    
+    def archive_old_conversations(self, max_age_days: int = ARCHIVE_AFTER_DAYS) -> int:
+        """
+        Move messages of ended consultations older than max_age_days to the archive
+        
+        The conversation rows (with their summaries) and patient history stay
+        in the main database, so context building and visit lists are
+        unaffected. Conversations are moved in batches of ARCHIVE_BATCH_SIZE.
+        In WAL mode a transaction is not atomic across attached databases,
+        so each batch is first copied to the archive and committed, then
+        removed from the main database; an interrupted batch is simply
+        copied again by the next run.
+        
+        Returns:
+            Number of conversations archived
+        """
+        self.init_archive_database()
+        
+        archived = 0
+        while True:
+            conn = self.connect_with_archive()
+            cursor = conn.cursor()
+            
+            try:
+                cursor.execute("""
+                    SELECT conversation_id FROM conversations
+                    WHERE archived = 0
+                      AND summary IS NOT NULL
+                      AND session_date < datetime('now', ?)
+                    ORDER BY conversation_id
+                    LIMIT ?
+                """, (f"-{int(max_age_days)} days", ARCHIVE_BATCH_SIZE))
+                conversation_ids = [row[0] for row in cursor.fetchall()]
+                
+                for conv_id in conversation_ids:
+                    # Replace any copy already in the archive (e.g. left by an
+                    # interrupted run or by restoring files from different
+                    # points in time)
+                    cursor.execute("DELETE FROM archive.messages WHERE conversation_id = ?", (conv_id,))
+                    cursor.execute("""
+                        INSERT INTO archive.messages
+                        (message_id, conversation_id, role, content, timestamp, content_encoding)
+                        SELECT message_id, conversation_id, role, content, timestamp, content_encoding
+                        FROM main.messages WHERE conversation_id = ?
+                    """, (conv_id,))
+                conn.commit()
+                
+                for conv_id in conversation_ids:
+                    cursor.execute("DELETE FROM main.messages WHERE conversation_id = ?", (conv_id,))
+                    cursor.execute("""
+                        UPDATE conversations SET archived = 1
+                        WHERE conversation_id = ?
+                    """, (conv_id,))
+                
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+            
+            archived += len(conversation_ids)
+            if len(conversation_ids) < ARCHIVE_BATCH_SIZE:
+                return archived
+    
+    def clear_all_data(self):
+        """Clear all data from all tables, including the archive (WARNING: Irreversible!)"""
+        conn = self.connect_with_archive()
+        cursor = conn.cursor()
+        
         try:
             # Delete in order to respect foreign key constraints
+            if self.archive_attached(cursor):
+                cursor.execute("DELETE FROM archive.messages")
+            cursor.execute("DELETE FROM usage")
+            cursor.execute("DELETE FROM patient_summaries")
             cursor.execute("DELETE FROM patient_history")
             cursor.execute("DELETE FROM messages")
             cursor.execute("DELETE FROM conversations")
             cursor.execute("DELETE FROM patients")
+            # Trained dictionaries embed fragments of message text
+            cursor.execute("DELETE FROM compression_dictionaries")
             
             conn.commit()
+            self.invalidate_patient_context()
+            self.codec = BodyCodec(self.codec.method, self.codec.threshold,
+                                   load_dictionary=self.load_compression_dictionary)
             return True
         except Exception as e:
             conn.rollback()
@@ -455,11 +1516,13 @@ When analyzing symptoms:
             conn.close()
 
     def clear_patient_data(self, patient_id: str):
-        """Clear all data for a specific patient"""
-        conn = sqlite3.connect(self.db_path)
+        """Clear all data for a specific patient, including archived messages"""
+        conn = self.connect_with_archive()
         cursor = conn.cursor()
         
         try:
+            archive_attached = self.archive_attached(cursor)
+            
             # Get all conversation IDs for this patient
             cursor.execute("SELECT conversation_id FROM conversations WHERE patient_id = ?", (patient_id,))
             conversation_ids = [row[0] for row in cursor.fetchall()]
@@ -467,12 +1530,17 @@ When analyzing symptoms:
             # Delete related data
             for conv_id in conversation_ids:
                 cursor.execute("DELETE FROM messages WHERE conversation_id = ?", (conv_id,))
+                if archive_attached:
+                    cursor.execute("DELETE FROM archive.messages WHERE conversation_id = ?", (conv_id,))
                 cursor.execute("DELETE FROM patient_history WHERE conversation_id = ?", (conv_id,))
             
+            cursor.execute("DELETE FROM usage WHERE patient_id = ?", (patient_id,))
+            cursor.execute("DELETE FROM patient_summaries WHERE patient_id = ?", (patient_id,))
             cursor.execute("DELETE FROM conversations WHERE patient_id = ?", (patient_id,))
             cursor.execute("DELETE FROM patients WHERE patient_id = ?", (patient_id,))
             
             conn.commit()
+            self.invalidate_patient_context(patient_id)
             return True
         except Exception as e:
             conn.rollback()
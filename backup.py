@@ -0,0 +1,244 @@
+"""
+Online backups and point-in-time snapshots of the medical assistant database
+
+Usage:
+    python backup.py snapshot [--db medical_assistant.db] [--dir backups] [--keep 7]
+    python backup.py list     [--db medical_assistant.db] [--dir backups]
+    python backup.py restore SNAPSHOT [--db medical_assistant.db]
+
+Snapshots are taken with SQLite's online backup API while the app keeps
+running. The main database and, when present, the archive database are copied
+a few pages per step from one connection inside one read transaction, so the
+snapshot directory holds both files as of the same point in time. The agent
+keeps its databases in WAL mode, where that read transaction does not block
+writers.
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Callable, List, Optional
+
+# Pages copied per backup step, and the pause between steps (seconds)
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP = 0.05
+
+# Snapshots kept by default; older ones are pruned after each new snapshot
+SNAPSHOT_RETENTION = 7
+
+# Default interval between scheduled snapshots (seconds)
+SNAPSHOT_INTERVAL = 60 * 60
+
+
+def default_archive_path(db_path: str) -> str:
+    """Archive database path used by MedicalAssistantAgent for db_path"""
+    return os.path.splitext(db_path)[0] + "_archive.db"
+
+
+def backup_databases(db_path: str, archive_path: str, dest_dir: str,
+                     pages: int = BACKUP_PAGES_PER_STEP,
+                     sleep: float = BACKUP_STEP_SLEEP):
+    """
+    Copy the live database and its archive (if any) into dest_dir consistently
+
+    Both files are read in a single transaction on one connection, so the
+    copies show the same point in time. Because the transaction stays open
+    between steps, writes by other connections go to the WAL without
+    restarting the copy, and (in WAL mode) without waiting for it. Copies
+    are written next to their destination and moved into place once complete.
+    """
+    source = sqlite3.connect(db_path)
+    databases = [("main", db_path)]
+    if os.path.exists(archive_path):
+        source.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+        databases.append(("archive", archive_path))
+
+    try:
+        # Start the read transaction on every database before copying any
+        source.execute("BEGIN")
+        for name, _ in databases:
+            source.execute(f"SELECT COUNT(*) FROM {name}.sqlite_master").fetchone()
+
+        for name, path in databases:
+            dest_path = os.path.join(dest_dir, os.path.basename(path))
+            partial_path = dest_path + ".partial"
+            dest = sqlite3.connect(partial_path)
+            try:
+                # sqlite3 only sleeps after a busy step; pause after every step
+                # so the copy does not saturate the disk
+                source.backup(dest, pages=pages, name=name,
+                              progress=lambda status, remaining, total: time.sleep(sleep))
+            finally:
+                dest.close()
+            os.replace(partial_path, dest_path)
+    finally:
+        source.rollback()
+        source.close()
+
+
+def create_snapshot(db_path: str, backup_dir: str = "backups",
+                    retention: int = SNAPSHOT_RETENTION,
+                    archive_path: Optional[str] = None) -> str:
+    """
+    Take a point-in-time snapshot of the database (and its archive, if any)
+
+    Returns:
+        Path of the new snapshot directory
+    """
+    archive_path = archive_path or default_archive_path(db_path)
+    stem = os.path.splitext(os.path.basename(db_path))[0]
+    snapshot_dir = os.path.join(backup_dir, f"{stem}-{datetime.now():%Y%m%d-%H%M%S-%f}")
+    os.makedirs(snapshot_dir)
+
+    try:
+        backup_databases(db_path, archive_path, snapshot_dir)
+    except Exception:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+        raise
+
+    prune_snapshots(db_path, backup_dir, retention)
+    return snapshot_dir
+
+
+def list_snapshots(db_path: str, backup_dir: str = "backups") -> List[str]:
+    """Snapshot directories for db_path, oldest first"""
+    if not os.path.isdir(backup_dir):
+        return []
+
+    db_name = os.path.basename(db_path)
+    prefix = os.path.splitext(db_name)[0] + "-"
+    snapshots = [os.path.join(backup_dir, name) for name in os.listdir(backup_dir)
+                 if name.startswith(prefix)
+                 and os.path.exists(os.path.join(backup_dir, name, db_name))]
+    # Names embed a sortable timestamp
+    return sorted(snapshots)
+
+
+def prune_snapshots(db_path: str, backup_dir: str = "backups",
+                    retention: int = SNAPSHOT_RETENTION):
+    """Delete all but the newest `retention` snapshots"""
+    snapshots = list_snapshots(db_path, backup_dir)
+    for snapshot_dir in snapshots[:max(len(snapshots) - retention, 0)]:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+
+def restore_snapshot(snapshot_dir: str, db_path: str, archive_path: Optional[str] = None):
+    """
+    Restore the database (and archive) from a snapshot directory
+
+    The snapshot is copied into the existing files through the backup API in
+    a single step, so the restored state is consistent. Stop consultations
+    before restoring; writers are locked out until it completes.
+    """
+    archive_path = archive_path or default_archive_path(db_path)
+    snapshot_db = os.path.join(snapshot_dir, os.path.basename(db_path))
+    if not os.path.exists(snapshot_db):
+        raise FileNotFoundError(f"No database in snapshot: {snapshot_db}")
+
+    _copy_into(snapshot_db, db_path)
+
+    snapshot_archive = os.path.join(snapshot_dir, os.path.basename(archive_path))
+    if os.path.exists(snapshot_archive):
+        _copy_into(snapshot_archive, archive_path)
+    elif os.path.exists(archive_path):
+        # The snapshot predates the archive: clear archived messages so they
+        # do not outlive the restored conversations
+        conn = sqlite3.connect(archive_path)
+        conn.execute("DELETE FROM messages")
+        conn.commit()
+        conn.close()
+
+
+def _copy_into(source_path: str, dest_path: str):
+    """Overwrite dest_path's contents with source_path through the backup API"""
+    source = sqlite3.connect(source_path)
+    dest = sqlite3.connect(dest_path)
+    try:
+        source.backup(dest)
+    finally:
+        dest.close()
+        source.close()
+
+
+class SnapshotScheduler:
+    """Take snapshots periodically on a background timer"""
+
+    def __init__(self, db_path: str, backup_dir: str = "backups",
+                 interval: float = SNAPSHOT_INTERVAL,
+                 retention: int = SNAPSHOT_RETENTION,
+                 archive_path: Optional[str] = None,
+                 on_error: Optional[Callable[[Exception], None]] = None):
+        self.db_path = db_path
+        self.backup_dir = backup_dir
+        self.interval = interval
+        self.retention = retention
+        self.archive_path = archive_path
+        self.on_error = on_error
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._timer is not None
+
+    def start(self):
+        """Start taking snapshots every `interval` seconds"""
+        with self._lock:
+            if self._timer is None:
+                self._schedule()
+
+    def stop(self):
+        """Stop scheduled snapshots; a snapshot already in progress completes"""
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+
+    def _schedule(self):
+        self._timer = threading.Timer(self.interval, self._run)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _run(self):
+        try:
+            create_snapshot(self.db_path, self.backup_dir, self.retention, self.archive_path)
+        except Exception as e:
+            if self.on_error:
+                self.on_error(e)
+        with self._lock:
+            if self._timer is not None:
+                self._schedule()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Back up or restore the medical assistant database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    snapshot_parser = subparsers.add_parser("snapshot", help="Take a snapshot now")
+    snapshot_parser.add_argument("--keep", type=int, default=SNAPSHOT_RETENTION,
+                                 help="Number of snapshots to retain")
+    subparsers.add_parser("list", help="List snapshots")
+    restore_parser = subparsers.add_parser("restore", help="Restore from a snapshot directory")
+    restore_parser.add_argument("snapshot", help="Snapshot directory to restore")
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument("--db", default="medical_assistant.db", help="SQLite database")
+        subparser.add_argument("--dir", default="backups", help="Directory holding snapshots")
+
+    args = parser.parse_args()
+
+    if args.command == "snapshot":
+        print(f"Snapshot written to {create_snapshot(args.db, args.dir, args.keep)}")
+    elif args.command == "list":
+        for snapshot_dir in list_snapshots(args.db, args.dir):
+            print(snapshot_dir)
+    elif args.command == "restore":
+        restore_snapshot(args.snapshot, args.db)
+        print(f"Restored {args.db} from {args.snapshot}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Compare per-row dicts with the __slots__ records returned by the agent
+
+Usage: python benchmark_records.py [number_of_patients]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from MedicalAssitant import MedicalAssistantAgent
+
+
+def get_all_patients_as_dicts(db_path: str):
+    """The previous get_all_patients implementation, building a dict per row"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        SELECT patient_id, name, age, gender
+        FROM patients
+        ORDER BY name
+    """)
+
+    patients = []
+    for row in cursor.fetchall():
+        patients.append({
+            "patient_id": row[0],
+            "name": row[1],
+            "age": row[2],
+            "gender": row[3]
+        })
+
+    conn.close()
+    return patients
+
+
+def measure(label: str, load, format_entry):
+    """Report time and peak memory for loading the patient list and formatting its entries"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    patients = load()
+    loaded = time.perf_counter()
+    entries = [format_entry(patient) for patient in patients]
+    formatted = time.perf_counter()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{label:<8} load {loaded - start:7.3f}s  format {formatted - loaded:7.3f}s  "
+          f"held {current / 1e6:7.1f} MB  peak {peak / 1e6:7.1f} MB  ({len(entries)} rows)")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "benchmark.db")
+        agent = MedicalAssistantAgent(api_key="benchmark", db_path=db_path,
+                                      context_caching=False, background_summaries=False)
+
+        conn = sqlite3.connect(db_path)
+        conn.executemany("""
+            INSERT INTO patients (patient_id, name, age, gender)
+            VALUES (?, ?, ?, ?)
+        """, ((f"P{i:07d}", f"Patient {i}", 20 + i % 70, ("Male", "Female", "Other")[i % 3])
+              for i in range(count)))
+        conn.commit()
+        conn.close()
+
+        print(f"Loading {count} patients")
+        measure("dicts", lambda: get_all_patients_as_dicts(db_path),
+                lambda p: f"{p['name']} ({p['patient_id']}) - {p['age']}y, {p['gender']}")
+        measure("records", agent.get_all_patients,
+                lambda p: f"{p.name} ({p.patient_id}) - {p.age}y, {p.gender}")
+
+
+if __name__ == "__main__":
+    main()
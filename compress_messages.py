@@ -0,0 +1,164 @@
+"""
+Convert stored message and summary bodies to the compressed storage format
+
+Usage:
+    python compress_messages.py [--db medical_assistant.db] [--method zlib|zstd]
+                                [--threshold BYTES] [--train-dictionary] [--vacuum]
+
+Rows are re-encoded in small batches so the app can keep running; a row
+changed by the app between reading and writing its batch is left for the
+next run. Messages already moved to the archive database are converted too.
+The space used by bodies before and after is reported; pass --vacuum to also
+shrink the database files.
+"""
+import argparse
+import os
+import sqlite3
+
+from compression import COMPRESSION_THRESHOLD, train_dictionary
+from MedicalAssitant import MedicalAssistantAgent
+
+BATCH_SIZE = 500
+
+# Number of message bodies sampled to train a zstd dictionary
+DICTIONARY_SAMPLES = 2000
+
+
+def body_bytes(agent: MedicalAssistantAgent) -> int:
+    """Total stored size of message (hot and archived) and summary bodies"""
+    conn = agent.connect_with_archive()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COALESCE(SUM(LENGTH(CAST(content AS BLOB))), 0) FROM messages")
+    total = cursor.fetchone()[0]
+    cursor.execute("SELECT COALESCE(SUM(LENGTH(CAST(visits_text AS BLOB))), 0) FROM patient_summaries")
+    total += cursor.fetchone()[0]
+    if agent.archive_attached(cursor):
+        cursor.execute("SELECT COALESCE(SUM(LENGTH(CAST(content AS BLOB))), 0) FROM archive.messages")
+        total += cursor.fetchone()[0]
+    conn.close()
+    return total
+
+
+def train(agent: MedicalAssistantAgent) -> None:
+    """Train a shared dictionary from a sample of message bodies and store it"""
+    samples = []
+    for message_id, content, encoding in fetch_batches(agent.db_path, "messages", "message_id",
+                                                      "content", "content_encoding"):
+        samples.append(agent.codec.decode(content, encoding))
+        if len(samples) >= DICTIONARY_SAMPLES:
+            break
+
+    try:
+        dict_id = agent.save_compression_dictionary(train_dictionary(samples))
+        print(f"Trained dictionary {dict_id} from {len(samples)} messages")
+    except Exception as e:
+        print(f"Dictionary training skipped ({e}); compressing without a dictionary")
+
+
+def fetch_batches(db_path: str, table: str, key: str, body: str, encoding: str):
+    """Yield (key, body, encoding) rows in key order, one short read per batch"""
+    last_key = None
+    while True:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        if last_key is None:
+            cursor.execute(f"SELECT {key}, {body}, {encoding} FROM {table} "
+                           f"ORDER BY {key} LIMIT ?", (BATCH_SIZE,))
+        else:
+            cursor.execute(f"SELECT {key}, {body}, {encoding} FROM {table} "
+                           f"WHERE {key} > ? ORDER BY {key} LIMIT ?", (last_key, BATCH_SIZE))
+        rows = cursor.fetchall()
+        conn.close()
+
+        yield from rows
+        if len(rows) < BATCH_SIZE:
+            return
+        last_key = rows[-1][0]
+
+
+def convert(agent: MedicalAssistantAgent, db_path: str, table: str, key: str,
+            body: str, encoding: str) -> int:
+    """Re-encode every body in a table with the agent's codec; returns rows changed"""
+    changed = 0
+    pending = []
+
+    def flush():
+        nonlocal changed
+        conn = sqlite3.connect(db_path)
+        # Only overwrite rows still holding the value that was read, so a
+        # concurrent write (e.g. end_conversation extending a summary) wins
+        cursor = conn.executemany(f"UPDATE {table} SET {body} = ?, {encoding} = ? "
+                                  f"WHERE {key} = ? AND {body} IS ? AND {encoding} IS ?", pending)
+        changed += cursor.rowcount
+        conn.commit()
+        conn.close()
+        pending.clear()
+
+    for row_key, value, current_encoding in fetch_batches(db_path, table, key, body, encoding):
+        if value is None:
+            continue
+        text = agent.codec.decode(value, current_encoding)
+        new_value, new_encoding = agent.codec.encode(text)
+        if new_encoding != current_encoding:
+            pending.append((new_value, new_encoding, row_key, value, current_encoding))
+        if len(pending) >= BATCH_SIZE:
+            flush()
+
+    if pending:
+        flush()
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--db", default="medical_assistant.db", help="SQLite database to convert")
+    parser.add_argument("--method", default="zlib", choices=["zlib", "zstd"], help="Compression method")
+    parser.add_argument("--threshold", type=int, default=COMPRESSION_THRESHOLD,
+                        help="Minimum body size in bytes before compressing")
+    parser.add_argument("--train-dictionary", action="store_true",
+                        help="Train a shared zstd dictionary from existing messages first")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM the database afterwards")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"Database not found: {args.db}")
+
+    agent = MedicalAssistantAgent(api_key="", db_path=args.db, context_caching=False,
+                                  background_summaries=False, compression=args.method)
+    agent.codec.threshold = args.threshold
+    if agent.codec.method != args.method:
+        print(f"{args.method} is not available; using {agent.codec.method}")
+
+    if args.train_dictionary:
+        if agent.codec.method == "zstd":
+            train(agent)
+        else:
+            print("Dictionary training requires zstd; skipping")
+
+    db_paths = [args.db] + ([agent.archive_path] if os.path.exists(agent.archive_path) else [])
+    before = body_bytes(agent)
+    files_before = sum(os.path.getsize(path) for path in db_paths)
+
+    messages = convert(agent, args.db, "messages", "message_id", "content", "content_encoding")
+    summaries = convert(agent, args.db, "patient_summaries", "patient_id", "visits_text", "visits_encoding")
+    archived = 0
+    if len(db_paths) > 1:
+        archived = convert(agent, agent.archive_path, "messages", "message_id", "content", "content_encoding")
+
+    after = body_bytes(agent)
+    print(f"Re-encoded {messages} messages, {archived} archived messages "
+          f"and {summaries} patient summaries")
+    print(f"Body storage: {before:,} -> {after:,} bytes "
+          f"({(1 - after / before) * 100 if before else 0:.1f}% saved)")
+
+    if args.vacuum:
+        for path in db_paths:
+            conn = sqlite3.connect(path)
+            conn.execute("VACUUM")
+            conn.close()
+        print(f"Database files: {files_before:,} -> "
+              f"{sum(os.path.getsize(path) for path in db_paths):,} bytes")
+
+
+if __name__ == "__main__":
+    main()
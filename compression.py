@@ -0,0 +1,116 @@
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    # zstd (and trained dictionaries) are optional; zlib is always available
+    zstandard = None
+
+# Bodies shorter than this (in UTF-8 bytes) are stored as plain text
+COMPRESSION_THRESHOLD = 1024
+
+# Size of a trained zstd dictionary
+DICTIONARY_SIZE = 64 * 1024
+
+
+class BodyCodec:
+    """
+    Encode large message/summary bodies for storage and decode them on read
+
+    Encoded values are stored alongside an encoding tag:
+        None          plain text
+        'zlib'        zlib-compressed UTF-8
+        'zstd'        zstd-compressed UTF-8
+        'zstd:<id>'   zstd-compressed with the shared dictionary <id>
+    """
+
+    def __init__(self, method: Optional[str] = None,
+                 threshold: int = COMPRESSION_THRESHOLD,
+                 dictionaries: Optional[Dict[int, bytes]] = None,
+                 load_dictionary: Optional[Callable[[int], Optional[bytes]]] = None):
+        """
+        Args:
+            method: 'zlib', 'zstd' or None to store new bodies uncompressed
+            threshold: Minimum body size in bytes before compressing
+            dictionaries: Known zstd dictionaries by id; the newest is used to encode
+            load_dictionary: Fetches a dictionary the codec has not seen yet
+        """
+        if method == 'zstd' and zstandard is None:
+            method = 'zlib'
+        if method not in (None, 'zlib', 'zstd'):
+            raise ValueError(f"Unknown compression method: {method}")
+
+        self.method = method
+        self.threshold = threshold
+        self.load_dictionary = load_dictionary
+        self._dictionaries: Dict[int, object] = {}
+        for dict_id, data in (dictionaries or {}).items():
+            self.add_dictionary(dict_id, data)
+
+    def add_dictionary(self, dict_id: int, data: bytes):
+        """Register a trained zstd dictionary"""
+        if zstandard is not None:
+            self._dictionaries[dict_id] = zstandard.ZstdCompressionDict(data)
+
+    def _dictionary(self, dict_id: int):
+        if dict_id not in self._dictionaries and self.load_dictionary:
+            data = self.load_dictionary(dict_id)
+            if data is not None:
+                self.add_dictionary(dict_id, data)
+        if dict_id not in self._dictionaries:
+            raise ValueError(f"Unknown zstd dictionary: {dict_id}")
+        return self._dictionaries[dict_id]
+
+    def encode(self, text: str, method: Optional[str] = None) -> Tuple[object, Optional[str]]:
+        """Return (stored value, encoding) for a body"""
+        method = method or self.method
+        if method is None or text is None:
+            return text, None
+
+        raw = text.encode('utf-8')
+        if len(raw) < self.threshold:
+            return text, None
+
+        if method == 'zstd' and zstandard is not None:
+            if self._dictionaries:
+                dict_id = max(self._dictionaries)
+                compressor = zstandard.ZstdCompressor(dict_data=self._dictionaries[dict_id])
+                encoding = f"zstd:{dict_id}"
+            else:
+                compressor = zstandard.ZstdCompressor()
+                encoding = "zstd"
+            compressed = compressor.compress(raw)
+        else:
+            compressed = zlib.compress(raw, 6)
+            encoding = "zlib"
+
+        # Keep incompressible bodies as text
+        if len(compressed) >= len(raw):
+            return text, None
+        return compressed, encoding
+
+    def decode(self, value, encoding: Optional[str]) -> str:
+        """Turn a stored value back into text"""
+        if encoding is None:
+            return value
+        if encoding == 'zlib':
+            return zlib.decompress(value).decode('utf-8')
+        if encoding.startswith('zstd'):
+            if zstandard is None:
+                raise RuntimeError("zstandard is required to read zstd-compressed bodies")
+            if ':' in encoding:
+                dict_data = self._dictionary(int(encoding.split(':', 1)[1]))
+                decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+            else:
+                decompressor = zstandard.ZstdDecompressor()
+            return decompressor.decompress(value).decode('utf-8')
+        raise ValueError(f"Unknown body encoding: {encoding}")
+
+
+def train_dictionary(samples: List[str], size: int = DICTIONARY_SIZE) -> bytes:
+    """Train a shared zstd dictionary from sample bodies"""
+    if zstandard is None:
+        raise RuntimeError("zstandard is required to train a dictionary")
+    trained = zstandard.train_dictionary(size, [sample.encode('utf-8') for sample in samples])
+    return trained.as_bytes()
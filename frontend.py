@@ -1,7 +1,416 @@
+import os
+import queue
+import threading
 import tkinter as tk
-from tkinter import ttk, scrolledtext, messagebox, simpledialog
+from collections import deque
+from tkinter import ttk, scrolledtext, messagebox, simpledialog, filedialog
 from datetime import datetime
-from MedicalAssitant import MedicalAssistantAgent
+from MedicalAssitant import MedicalAssistantAgent, ARCHIVE_AFTER_DAYS
+from records import Visit
+import backup
+
+# Chat turns kept in a tab's display; older messages are paged in on demand
+MAX_RENDERED_TURNS = 20
+TRANSCRIPT_PAGE_SIZE = 20
+
+
+class ConsultationSession:
+    """
+    A single consultation tab with its own conversation state and in-flight request
+    
+    The chat display is a bounded buffer: only the last MAX_RENDERED_TURNS
+    turns stay in the widget and older messages are paged back in from the
+    database on request. Past consultations open as read-only tabs.
+    """
+    
+    def __init__(self, gui, patient_id: str, patient_name: str,
+                 conversation_id: int, complaint: str, read_only: bool = False):
+        self.gui = gui
+        self.agent = gui.agent
+        self.patient_id = patient_id
+        self.patient_name = patient_name
+        self.conversation_id = conversation_id
+        self.read_only = read_only
+        self.pending = False
+        self.ended = read_only
+        self.closed = False
+        
+        # Rendered messages as (mark name, message_id); message_id is None for
+        # messages rendered live, before their database id is known
+        self.blocks = deque()
+        self.block_counter = 0
+        self.has_older = False
+        self.loading_older = False
+        
+        self.frame = ttk.Frame(gui.notebook, padding="10")
+        self.frame.columnconfigure(0, weight=1)
+        self.frame.rowconfigure(0, weight=1)
+        gui.notebook.add(self.frame, text=self.tab_title())
+        
+        self.setup_widgets()
+        
+        # Display consultation start
+        if read_only:
+            self.append(f"=== CONSULTATION TRANSCRIPT ===\n", "system")
+        else:
+            self.append(f"=== CONSULTATION STARTED ===\n", "system")
+        self.append(f"Patient: {patient_id}\n", "system")
+        self.append(f"Chief Complaint: {complaint}\n", "system")
+        self.append(f"{'='*40}\n\n", "system")
+        
+        # Messages are rendered after this mark; left gravity keeps it in place
+        # when older messages are inserted at it
+        self.chat_display.mark_set("history_start", "end-1c")
+        self.chat_display.mark_gravity("history_start", tk.LEFT)
+        
+        if read_only:
+            self.send_btn.config(state=tk.DISABLED)
+            self.end_consultation_btn.config(state=tk.DISABLED)
+            self.load_older_messages()
+    
+    def setup_widgets(self):
+        """Build the chat and summary widgets for this tab"""
+        chat_frame = ttk.Frame(self.frame)
+        chat_frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        chat_frame.columnconfigure(0, weight=1)
+        chat_frame.rowconfigure(1, weight=1)
+        
+        self.load_older_btn = ttk.Button(chat_frame, text="Load Earlier Messages",
+                                         command=self.load_older_messages, state=tk.DISABLED)
+        self.load_older_btn.grid(row=0, column=0, sticky=tk.W)
+        
+        # Chat display
+        self.chat_display = scrolledtext.ScrolledText(chat_frame, wrap=tk.WORD, height=20)
+        self.chat_display.grid(row=1, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), pady=5)
+        self.chat_display.config(state=tk.DISABLED)
+        
+        # Configure tags for styling
+        self.chat_display.tag_config("user", foreground="blue", font=("Arial", 10, "bold"))
+        self.chat_display.tag_config("assistant", foreground="green", font=("Arial", 10))
+        self.chat_display.tag_config("system", foreground="gray", font=("Arial", 9, "italic"))
+        
+        # Input frame
+        input_frame = ttk.Frame(chat_frame)
+        input_frame.grid(row=2, column=0, sticky=(tk.W, tk.E), pady=5)
+        input_frame.columnconfigure(0, weight=1)
+        
+        ttk.Label(input_frame, text="Your message:").grid(row=0, column=0, sticky=tk.W)
+        
+        self.message_input = scrolledtext.ScrolledText(input_frame, height=3, wrap=tk.WORD)
+        self.message_input.grid(row=1, column=0, sticky=(tk.W, tk.E), pady=5)
+        
+        self.send_btn = ttk.Button(input_frame, text="Send Message", command=self.send_message)
+        self.send_btn.grid(row=2, column=0, pady=5)
+        
+        # Consultation summary (ALWAYS VISIBLE)
+        summary_frame = ttk.LabelFrame(self.frame, text="End Consultation", padding="10")
+        summary_frame.grid(row=1, column=0, sticky=(tk.W, tk.E), pady=(5, 0))
+        summary_frame.columnconfigure(1, weight=1)
+        
+        ttk.Label(summary_frame, text="Summary:").grid(row=0, column=0, sticky=tk.W, padx=5)
+        self.summary_entry = ttk.Entry(summary_frame)
+        self.summary_entry.grid(row=0, column=1, sticky=(tk.W, tk.E), padx=5, pady=2)
+        
+        ttk.Label(summary_frame, text="Symptoms:").grid(row=1, column=0, sticky=tk.W, padx=5)
+        self.symptoms_entry = ttk.Entry(summary_frame)
+        self.symptoms_entry.grid(row=1, column=1, sticky=(tk.W, tk.E), padx=5, pady=2)
+        
+        ttk.Label(summary_frame, text="Diagnoses:").grid(row=2, column=0, sticky=tk.W, padx=5)
+        self.diagnoses_entry = ttk.Entry(summary_frame)
+        self.diagnoses_entry.grid(row=2, column=1, sticky=(tk.W, tk.E), padx=5, pady=2)
+        
+        btn_frame = ttk.Frame(summary_frame)
+        btn_frame.grid(row=3, column=0, columnspan=2, pady=5)
+        
+        self.end_consultation_btn = ttk.Button(btn_frame, text="📋 End Consultation", 
+                                            command=self.end_consultation)
+        self.end_consultation_btn.pack(side=tk.LEFT, padx=2)
+        ttk.Button(btn_frame, text="Close Tab", command=self.close).pack(side=tk.LEFT, padx=2)
+    
+    def tab_title(self) -> str:
+        """Notebook tab label, marked while a request is in flight"""
+        title = f"{self.patient_name} #{self.conversation_id}"
+        if self.read_only:
+            title = "📄 " + title
+        elif self.pending:
+            title = "⏳ " + title
+        elif self.ended:
+            title = "✔ " + title
+        return title
+    
+    def set_pending(self, pending: bool):
+        """Mark this tab as waiting on the agent"""
+        self.pending = pending
+        self.gui.notebook.tab(self.frame, text=self.tab_title())
+        self.update_load_older_btn()
+    
+    def if_open(self, callback):
+        """Wrap a worker-thread callback so it is dropped once the tab is closed"""
+        def wrapper(*args):
+            if not self.closed:
+                callback(*args)
+        return wrapper
+    
+    def append(self, text: str, tag: str = None):
+        """Append text to the chat display"""
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.insert(tk.END, text, tag)
+        self.chat_display.config(state=tk.DISABLED)
+        self.chat_display.see(tk.END)
+    
+    def message_chunks(self, role: str, content: str) -> tuple:
+        """Text/tag pairs used to render one message"""
+        if role == "user":
+            return ("Doctor: ", "user", f"{content}\n\n", ())
+        return ("Assistant: ", "assistant", f"{content}\n\n", (),
+                f"{'-'*40}\n\n", "system")
+    
+    def append_message(self, role: str, content: str, message_id: int = None):
+        """Append a message to the display and trim the oldest past the limit"""
+        start = self.chat_display.index("end-1c")
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.insert(tk.END, *self.message_chunks(role, content))
+        
+        self.block_counter += 1
+        mark = f"block{self.block_counter}"
+        self.chat_display.mark_set(mark, start)
+        self.blocks.append((mark, message_id))
+        
+        while len(self.blocks) > MAX_RENDERED_TURNS * 2:
+            oldest, _ = self.blocks.popleft()
+            self.chat_display.delete("history_start", self.blocks[0][0])
+            self.chat_display.mark_unset(oldest)
+            self.has_older = True
+        
+        self.chat_display.config(state=tk.DISABLED)
+        self.chat_display.see(tk.END)
+        self.update_load_older_btn()
+    
+    def prepend_messages(self, messages: list):
+        """Insert a page of older messages (oldest first) above those displayed"""
+        self.chat_display.config(state=tk.NORMAL)
+        for message in reversed(messages):
+            self.chat_display.insert("history_start",
+                                     *self.message_chunks(message.role, message.content))
+            self.block_counter += 1
+            mark = f"block{self.block_counter}"
+            self.chat_display.mark_set(mark, "history_start")
+            self.blocks.appendleft((mark, message.message_id))
+        self.chat_display.config(state=tk.DISABLED)
+    
+    def update_load_older_btn(self):
+        """Enable paging only when older messages exist and no request is in flight"""
+        enabled = self.has_older and not self.pending and not self.loading_older
+        self.load_older_btn.config(state=tk.NORMAL if enabled else tk.DISABLED)
+    
+    def load_older_messages(self):
+        """Page in the messages preceding the oldest one displayed"""
+        self.loading_older = True
+        self.update_load_older_btn()
+        
+        rendered = len(self.blocks)
+        # Messages of a failed turn have no id; page in from the oldest stored one
+        oldest_id = next((message_id for _, message_id in self.blocks if message_id is not None), None)
+        conversation_id = self.conversation_id
+        # Transcripts of past consultations may have been moved to the archive
+        include_archive = self.read_only
+        
+        def work():
+            return self.agent.get_conversation_messages(
+                conversation_id, before_message_id=oldest_id, limit=TRANSCRIPT_PAGE_SIZE,
+                include_archive=include_archive)
+        
+        def on_success(messages):
+            self.prepend_messages(messages)
+            self.has_older = len(messages) == TRANSCRIPT_PAGE_SIZE
+            if not rendered:
+                self.chat_display.see(tk.END)
+        
+        def on_error(e):
+            messagebox.showerror("Error", f"Failed to load messages: {str(e)}")
+        
+        def on_done():
+            self.loading_older = False
+            self.update_load_older_btn()
+        
+        self.gui.run_in_background(work, self.if_open(on_success),
+                                   self.if_open(on_error), self.if_open(on_done))
+    
+    def send_message(self):
+        """Send a message to the AI assistant without blocking other tabs"""
+        if self.ended:
+            messagebox.showerror("Error", "No active consultation!")
+            return
+        
+        message = self.message_input.get(1.0, tk.END).strip()
+        if not message:
+            return
+        
+        # Display user message; its id is filled in once the turn is stored
+        self.append_message("user", message)
+        user_block = self.blocks[-1][0]
+        
+        # Clear input
+        self.message_input.delete(1.0, tk.END)
+        
+        # Disable this tab's buttons while processing
+        self.send_btn.config(state=tk.DISABLED, text="Processing...")
+        self.end_consultation_btn.config(state=tk.DISABLED)
+        self.set_pending(True)
+        
+        def on_success(turn):
+            # Record the stored id of the query (unless already trimmed), then
+            # display the AI response
+            for index, (mark, _) in enumerate(self.blocks):
+                if mark == user_block:
+                    self.blocks[index] = (mark, turn.user_message_id)
+                    break
+            self.append_message("assistant", turn.response, turn.response_message_id)
+        
+        def on_error(e):
+            messagebox.showerror("Error", f"Failed to get response: {str(e)}")
+        
+        def on_done():
+            # Re-enable this tab's buttons
+            self.set_pending(False)
+            if not self.ended:
+                self.send_btn.config(state=tk.NORMAL, text="Send")
+                self.end_consultation_btn.config(state=tk.NORMAL)
+        
+        self.gui.run_in_background(
+            lambda: self.agent.chat_turn(self.patient_id, self.conversation_id, message),
+            self.if_open(on_success), self.if_open(on_error), self.if_open(on_done)
+        )
+    
+    def end_consultation(self):
+        """End the consultation with automated summarization"""
+        if self.ended:
+            messagebox.showerror("Error", "No active consultation!")
+            return
+        
+        # Show the background draft right away while the last turns are folded in
+        draft = self.agent.get_draft_summary(self.conversation_id)
+        if draft:
+            self.fill_summary_fields(draft)
+        
+        # Show processing message
+        self.end_consultation_btn.config(text="Generating Summary...", state=tk.DISABLED)
+        self.send_btn.config(state=tk.DISABLED)
+        self.set_pending(True)
+        
+        def on_success(summary_data):
+            # Fill in the fields automatically
+            self.fill_summary_fields(summary_data)
+            
+            # Bring this tab forward before asking for confirmation
+            self.gui.notebook.select(self.frame)
+            response = messagebox.askyesno(
+                "Review Summary",
+                f"AI has generated the consultation summary for {self.patient_name}. "
+                "Would you like to review/edit before saving?\n\n"
+                "Click 'Yes' to review and edit\n"
+                "Click 'No' to save as is"
+            )
+            
+            if response:  # User wants to review
+                self.end_consultation_btn.config(text="Save Consultation", state=tk.NORMAL,
+                                                 command=self.save_consultation_after_review)
+                messagebox.showinfo("Review Mode", 
+                                "Please review the Summary, Symptoms, and Diagnoses fields below.\n"
+                                "Edit if needed, then click 'Save Consultation' when ready.")
+                return
+            
+            # User clicked No - save immediately
+            self.save_final_consultation(summary_data['summary'], 
+                                        summary_data['symptoms'], 
+                                        summary_data['diagnoses'])
+        
+        def on_error(e):
+            messagebox.showerror("Error", f"Failed to generate summary: {str(e)}")
+            self.end_consultation_btn.config(text="End Consultation", state=tk.NORMAL)
+            self.send_btn.config(state=tk.NORMAL)
+        
+        self.gui.run_in_background(
+            lambda: self.agent.generate_consultation_summary(self.conversation_id),
+            self.if_open(on_success), self.if_open(on_error),
+            self.if_open(lambda: self.set_pending(False))
+        )
+
+    def fill_summary_fields(self, summary_data: dict):
+        """Populate the summary, symptoms and diagnoses fields"""
+        self.summary_entry.delete(0, tk.END)
+        self.summary_entry.insert(0, summary_data['summary'])
+        
+        self.symptoms_entry.delete(0, tk.END)
+        self.symptoms_entry.insert(0, summary_data['symptoms'])
+        
+        self.diagnoses_entry.delete(0, tk.END)
+        self.diagnoses_entry.insert(0, summary_data['diagnoses'])
+
+    def save_consultation_after_review(self):
+        """Save consultation after user has reviewed/edited the summary"""
+        summary = self.summary_entry.get().strip()
+        symptoms = self.symptoms_entry.get().strip()
+        diagnoses = self.diagnoses_entry.get().strip()
+        
+        if not all([summary, symptoms, diagnoses]):
+            messagebox.showwarning("Warning", "Please ensure all fields are filled!")
+            return
+        
+        self.save_final_consultation(summary, symptoms, diagnoses)
+
+    def save_final_consultation(self, summary: str, symptoms: str, diagnoses: str):
+        """Final save of consultation to database"""
+        # Save consultation
+        self.agent.end_conversation(
+            self.conversation_id,
+            summary,
+            symptoms,
+            diagnoses
+        )
+        
+        # Display end message in chat
+        self.append("\n" + "="*60 + "\n", "system")
+        self.append("=== CONSULTATION ENDED ===\n", "system")
+        self.append(f"Summary: {summary}\n", "system")
+        self.append(f"Symptoms: {symptoms}\n", "system")
+        self.append(f"Diagnoses: {diagnoses}\n", "system")
+        self.append("="*60 + "\n", "system")
+        
+        # Lock the tab; it stays open as a read-only transcript until closed
+        self.ended = True
+        self.send_btn.config(state=tk.DISABLED)
+        self.end_consultation_btn.config(text="End Consultation", state=tk.DISABLED, 
+                                        command=self.end_consultation)
+        self.gui.notebook.tab(self.frame, text=self.tab_title())
+        
+        # Clear summary fields
+        self.summary_entry.delete(0, tk.END)
+        self.symptoms_entry.delete(0, tk.END)
+        self.diagnoses_entry.delete(0, tk.END)
+        
+        # Refresh patient info to show new visit, and rebuild the context the
+        # new visit invalidated
+        if self.gui.current_patient_id == self.patient_id:
+            self.gui.display_patient_info(self.patient_id)
+        self.agent.prefetch_patient_context(self.patient_id)
+        
+        messagebox.showinfo("Success", "Consultation saved successfully!")
+    
+    def close(self, confirm: bool = True):
+        """Close this tab; an unfinished consultation stays open in the database"""
+        if confirm and not self.ended:
+            if not messagebox.askyesno(
+                "Close Consultation",
+                f"The consultation for {self.patient_name} has not been ended.\n\n"
+                "Close the tab anyway?"
+            ):
+                return
+        
+        # Stop background summarization for a consultation nobody is watching
+        if not self.read_only:
+            self.agent.discard_draft_summary(self.conversation_id)
+        self.gui.close_session(self)
 
 
 class MedicalAssistantGUI:
@@ -15,15 +424,28 @@ class MedicalAssistantGUI:
         # Initialize agent
         self.agent = MedicalAssistantAgent(api_key=api_key)
         
-        # Current session variables
+        # Selected patient; each open consultation lives in its own tab
         self.current_patient_id = None
-        self.current_conversation_id = None
+        self.sessions = {}
+        
+        # Results from worker threads are handed back to Tk through this queue
+        self.ui_queue = queue.Queue()
+        
+        # Snapshots go to a backups folder next to the database
+        self.backup_dir = os.path.join(os.path.dirname(os.path.abspath(self.agent.db_path)), "backups")
+        self.snapshot_scheduler = backup.SnapshotScheduler(
+            self.agent.db_path, self.backup_dir, archive_path=self.agent.archive_path,
+            on_error=lambda e: self.ui_queue.put(
+                lambda: messagebox.showerror("Backup Failed", f"Scheduled snapshot failed: {str(e)}"))
+        )
+        self.scheduled_backups = tk.BooleanVar(value=False)
         
         # Add menu bar
         self.create_menu()
         
         # Setup GUI
         self.setup_gui()
+        self.poll_ui_queue()
         
     def setup_gui(self):
         """Setup the GUI layout"""
@@ -48,6 +470,9 @@ class MedicalAssistantGUI:
         self.patient_listbox = tk.Listbox(left_frame, height=8, width=30)  # Reduced height
         self.patient_listbox.grid(row=1, column=0, columnspan=2, pady=5, sticky=(tk.W, tk.E))
         self.patient_listbox.bind('<<ListboxSelect>>', self.on_patient_select)
+        self.patient_listbox.bind('<Motion>', self.on_patient_hover)
+        self.hover_index = None
+        self.hover_job = None
         
         # Buttons for patient management
         btn_frame = ttk.Frame(left_frame)
@@ -68,61 +493,19 @@ class MedicalAssistantGUI:
                                                 command=self.start_consultation, state=tk.DISABLED)
         self.start_consultation_btn.grid(row=5, column=0, columnspan=2, pady=10)
         
+        self.view_history_btn = ttk.Button(left_frame, text="View Past Consultations",
+                                           command=self.open_past_consultations_dialog, state=tk.DISABLED)
+        self.view_history_btn.grid(row=6, column=0, columnspan=2)
+        
         # Right Panel Container
         right_container = ttk.Frame(main_frame)
         right_container.grid(row=0, column=1, sticky=(tk.W, tk.E, tk.N, tk.S), padx=5)
         right_container.columnconfigure(0, weight=1)
         right_container.rowconfigure(0, weight=1)
         
-        # Right Panel - Chat Interface
-        chat_frame = ttk.LabelFrame(right_container, text="Consultation", padding="10")
-        chat_frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
-        chat_frame.columnconfigure(0, weight=1)
-        chat_frame.rowconfigure(0, weight=1)
-        
-        # Chat display
-        self.chat_display = scrolledtext.ScrolledText(chat_frame, wrap=tk.WORD, height=20)  # Reduced height
-        self.chat_display.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), pady=5)
-        self.chat_display.config(state=tk.DISABLED)
-        
-        # Configure tags for styling
-        self.chat_display.tag_config("user", foreground="blue", font=("Arial", 10, "bold"))
-        self.chat_display.tag_config("assistant", foreground="green", font=("Arial", 10))
-        self.chat_display.tag_config("system", foreground="gray", font=("Arial", 9, "italic"))
-        
-        # Input frame
-        input_frame = ttk.Frame(chat_frame)
-        input_frame.grid(row=1, column=0, sticky=(tk.W, tk.E), pady=5)
-        input_frame.columnconfigure(0, weight=1)
-        
-        ttk.Label(input_frame, text="Your message:").grid(row=0, column=0, sticky=tk.W)
-        
-        self.message_input = scrolledtext.ScrolledText(input_frame, height=3, wrap=tk.WORD)  # Reduced height
-        self.message_input.grid(row=1, column=0, sticky=(tk.W, tk.E), pady=5)
-        
-        self.send_btn = ttk.Button(input_frame, text="Send Message", command=self.send_message, state=tk.DISABLED)
-        self.send_btn.grid(row=2, column=0, pady=5)
-        
-        # Bottom Panel - Consultation Summary (ALWAYS VISIBLE)
-        summary_frame = ttk.LabelFrame(right_container, text="End Consultation", padding="10")
-        summary_frame.grid(row=1, column=0, sticky=(tk.W, tk.E), pady=(5, 0))
-        summary_frame.columnconfigure(1, weight=1)
-        
-        ttk.Label(summary_frame, text="Summary:").grid(row=0, column=0, sticky=tk.W, padx=5)
-        self.summary_entry = ttk.Entry(summary_frame)
-        self.summary_entry.grid(row=0, column=1, sticky=(tk.W, tk.E), padx=5, pady=2)
-        
-        ttk.Label(summary_frame, text="Symptoms:").grid(row=1, column=0, sticky=tk.W, padx=5)
-        self.symptoms_entry = ttk.Entry(summary_frame)
-        self.symptoms_entry.grid(row=1, column=1, sticky=(tk.W, tk.E), padx=5, pady=2)
-        
-        ttk.Label(summary_frame, text="Diagnoses:").grid(row=2, column=0, sticky=tk.W, padx=5)
-        self.diagnoses_entry = ttk.Entry(summary_frame)
-        self.diagnoses_entry.grid(row=2, column=1, sticky=(tk.W, tk.E), padx=5, pady=2)
-        
-        self.end_consultation_btn = ttk.Button(summary_frame, text="📋 End Consultation", 
-                                            command=self.end_consultation, state=tk.DISABLED)
-        self.end_consultation_btn.grid(row=3, column=0, columnspan=2, pady=5)
+        # Right Panel - Tabbed consultations
+        self.notebook = ttk.Notebook(right_container)
+        self.notebook.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
         
         # Initial load
         self.refresh_patient_list()
@@ -140,7 +523,81 @@ class MedicalAssistantGUI:
         db_menu.add_separator()
         db_menu.add_command(label="Delete Selected Patient", command=self.delete_selected_patient)
         db_menu.add_separator()
+        db_menu.add_command(label="Archive Old Consultations...", command=self.archive_old_consultations)
+        db_menu.add_separator()
+        db_menu.add_command(label="Backup Now", command=self.backup_now)
+        db_menu.add_checkbutton(label="Hourly Snapshots", variable=self.scheduled_backups,
+                                command=self.toggle_scheduled_backups)
+        db_menu.add_command(label="Restore from Snapshot...", command=self.restore_from_snapshot)
+        db_menu.add_separator()
         db_menu.add_command(label="Exit", command=self.root.quit)
+        
+        # Consultation menu
+        consult_menu = tk.Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="Consultation", menu=consult_menu)
+        
+        consult_menu.add_command(label="Start New Consultation", command=self.start_consultation)
+        consult_menu.add_command(label="Close Current Tab", command=self.close_current_tab)
+        
+        # Reports menu
+        reports_menu = tk.Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="Reports", menu=reports_menu)
+        
+        reports_menu.add_command(label="Token Usage...", command=self.open_usage_report)
+    
+    def run_in_background(self, work, on_success, on_error=None, on_done=None):
+        """
+        Run work() on a worker thread and deliver the outcome on the Tk thread
+        
+        on_success receives the result, on_error the exception; on_done runs
+        afterwards in either case.
+        """
+        def worker():
+            try:
+                result = work()
+            except Exception as e:
+                error = e
+                callbacks = [lambda: on_error(error)] if on_error else []
+            else:
+                callbacks = [lambda: on_success(result)]
+            if on_done:
+                callbacks.append(on_done)
+            for callback in callbacks:
+                self.ui_queue.put(callback)
+        
+        threading.Thread(target=worker, daemon=True).start()
+    
+    def poll_ui_queue(self):
+        """Run callbacks queued by worker threads"""
+        try:
+            while True:
+                callback = self.ui_queue.get_nowait()
+                try:
+                    callback()
+                except Exception as e:
+                    messagebox.showerror("Error", str(e))
+        except queue.Empty:
+            pass
+        self.root.after(50, self.poll_ui_queue)
+    
+    def close_session(self, session: ConsultationSession):
+        """Remove a consultation tab"""
+        session.closed = True
+        self.sessions.pop(str(session.frame), None)
+        self.notebook.forget(session.frame)
+        session.frame.destroy()
+    
+    def close_current_tab(self):
+        """Close the consultation tab currently shown"""
+        selected = self.notebook.select()
+        if selected and selected in self.sessions:
+            self.sessions[selected].close()
+    
+    def close_patient_sessions(self, patient_id: str = None):
+        """Close every tab for a patient (or all tabs if None) without prompting"""
+        for session in list(self.sessions.values()):
+            if patient_id is None or session.patient_id == patient_id:
+                session.close(confirm=False)
 
     def clear_all_data_confirm(self):
         """Confirm and clear all database data"""
@@ -164,15 +621,91 @@ class MedicalAssistantGUI:
                 success = self.agent.clear_all_data()
                 if success:
                     messagebox.showinfo("Success", "All data has been cleared.")
+                    self.close_patient_sessions()
                     self.refresh_patient_list()
                     self.patient_info_text.config(state=tk.NORMAL)
                     self.patient_info_text.delete(1.0, tk.END)
                     self.patient_info_text.config(state=tk.DISABLED)
                     self.current_patient_id = None
-                    self.current_conversation_id = None
                 else:
                     messagebox.showerror("Error", "Failed to clear data.")
 
+    def archive_old_consultations(self):
+        """Move messages of old, ended consultations to the archive database"""
+        days = simpledialog.askinteger(
+            "Archive Old Consultations",
+            "Archive ended consultations older than how many days?",
+            initialvalue=ARCHIVE_AFTER_DAYS, minvalue=0, parent=self.root
+        )
+        if days is None:
+            return
+        
+        def on_success(count):
+            messagebox.showinfo("Archive", f"{count} consultation(s) moved to the archive.\n\n"
+                                "Their summaries stay available; transcripts open from "
+                                "'View Past Consultations'.")
+        
+        def on_error(e):
+            messagebox.showerror("Error", f"Failed to archive consultations: {str(e)}")
+        
+        self.run_in_background(lambda: self.agent.archive_old_conversations(days),
+                               on_success, on_error)
+
+    def backup_now(self):
+        """Take a snapshot in the background without blocking consultations"""
+        def on_success(snapshot_dir):
+            messagebox.showinfo("Backup", f"Snapshot saved to:\n{snapshot_dir}")
+        
+        def on_error(e):
+            messagebox.showerror("Error", f"Backup failed: {str(e)}")
+        
+        self.run_in_background(
+            lambda: backup.create_snapshot(self.agent.db_path, self.backup_dir,
+                                           archive_path=self.agent.archive_path),
+            on_success, on_error
+        )
+    
+    def toggle_scheduled_backups(self):
+        """Start or stop periodic snapshots"""
+        if self.scheduled_backups.get():
+            self.snapshot_scheduler.start()
+        else:
+            self.snapshot_scheduler.stop()
+    
+    def restore_from_snapshot(self):
+        """Replace the database with a snapshot after closing every consultation"""
+        snapshot_dir = filedialog.askdirectory(title="Select Snapshot", initialdir=self.backup_dir,
+                                               parent=self.root)
+        if not snapshot_dir:
+            return
+        
+        if any(session.pending for session in self.sessions.values()):
+            messagebox.showwarning("Restore", "Wait for pending requests to finish before restoring.")
+            return
+        
+        if not messagebox.askyesno(
+            "⚠️ Restore Snapshot",
+            f"Replace ALL current data with the snapshot:\n{snapshot_dir}\n\n"
+            "Open consultations will be closed. Changes made after the snapshot will be lost!",
+            icon='warning'
+        ):
+            return
+        
+        try:
+            backup.restore_snapshot(snapshot_dir, self.agent.db_path, self.agent.archive_path)
+        except Exception as e:
+            messagebox.showerror("Error", f"Restore failed: {str(e)}")
+            return
+        
+        self.agent.reset_caches()
+        self.close_patient_sessions()
+        self.current_patient_id = None
+        self.refresh_patient_list()
+        self.patient_info_text.config(state=tk.NORMAL)
+        self.patient_info_text.delete(1.0, tk.END)
+        self.patient_info_text.config(state=tk.DISABLED)
+        messagebox.showinfo("Restore", "Database restored from snapshot.")
+
     def delete_selected_patient(self):
         """Delete the currently selected patient"""
         if not self.current_patient_id:
@@ -183,7 +716,7 @@ class MedicalAssistantGUI:
         
         response = messagebox.askyesno(
             "Confirm Deletion",
-            f"Delete patient: {patient_info['name']} ({self.current_patient_id})?\n\n"
+            f"Delete patient: {patient_info.name} ({self.current_patient_id})?\n\n"
             "This will delete all their consultations and history.\n"
             "This action cannot be undone!",
             icon='warning'
@@ -192,7 +725,8 @@ class MedicalAssistantGUI:
         if response:
             success = self.agent.clear_patient_data(self.current_patient_id)
             if success:
-                messagebox.showinfo("Success", f"Patient {patient_info['name']} has been deleted.")
+                messagebox.showinfo("Success", f"Patient {patient_info.name} has been deleted.")
+                self.close_patient_sessions(self.current_patient_id)
                 self.current_patient_id = None
                 self.refresh_patient_list()
                 self.patient_info_text.config(state=tk.NORMAL)
@@ -206,9 +740,33 @@ class MedicalAssistantGUI:
         self.patient_listbox.delete(0, tk.END)
         patients = self.agent.get_all_patients()
         
-        for patient in patients:
-            display_text = f"{patient['name']} ({patient['patient_id']}) - {patient['age']}y, {patient['gender']}"
-            self.patient_listbox.insert(tk.END, display_text)
+        # Insert all entries in a single Tk call
+        entries = [f"{patient.name} ({patient.patient_id}) - {patient.age}y, {patient.gender}"
+                   for patient in patients]
+        if entries:
+            self.patient_listbox.insert(tk.END, *entries)
+    
+    def patient_id_at(self, index: int) -> str:
+        """Extract the patient ID from a patient list entry"""
+        entry_text = self.patient_listbox.get(index)
+        return entry_text.split('(')[1].split(')')[0]
+    
+    def on_patient_hover(self, event):
+        """Prefetch context for a patient once the pointer rests on their entry"""
+        index = self.patient_listbox.nearest(event.y)
+        if index == self.hover_index or index < 0:
+            return
+        
+        self.hover_index = index
+        if self.hover_job:
+            self.root.after_cancel(self.hover_job)
+        
+        def prefetch():
+            self.hover_job = None
+            if index < self.patient_listbox.size():
+                self.agent.prefetch_patient_context(self.patient_id_at(index))
+        
+        self.hover_job = self.root.after(300, prefetch)
     
     def on_patient_select(self, event):
         """Handle patient selection"""
@@ -216,13 +774,15 @@ class MedicalAssistantGUI:
         if not selection:
             return
         
-        # Extract patient ID from selection
-        selected_text = self.patient_listbox.get(selection[0])
-        patient_id = selected_text.split('(')[1].split(')')[0]
+        patient_id = self.patient_id_at(selection[0])
+        
+        # Build the prompt context in the background for the next consultation
+        self.agent.prefetch_patient_context(patient_id)
         
         self.current_patient_id = patient_id
         self.display_patient_info(patient_id)
         self.start_consultation_btn.config(state=tk.NORMAL)
+        self.view_history_btn.config(state=tk.NORMAL)
     
     def display_patient_info(self, patient_id: str):
         """Display patient information and history"""
@@ -233,18 +793,18 @@ class MedicalAssistantGUI:
         self.patient_info_text.delete(1.0, tk.END)
         
         if patient_info:
-            info_text = f"ID: {patient_info['patient_id']}\n"
-            info_text += f"Name: {patient_info['name']}\n"
-            info_text += f"Age: {patient_info['age']}\n"
-            info_text += f"Gender: {patient_info['gender']}\n"
-            info_text += f"Registered: {patient_info['created_at']}\n\n"
+            info_text = f"ID: {patient_info.patient_id}\n"
+            info_text += f"Name: {patient_info.name}\n"
+            info_text += f"Age: {patient_info.age}\n"
+            info_text += f"Gender: {patient_info.gender}\n"
+            info_text += f"Registered: {patient_info.created_at}\n\n"
             
             info_text += "=== PREVIOUS VISITS ===\n"
             if patient_history:
                 for i, visit in enumerate(patient_history, 1):
                     info_text += f"\nVisit {i}:\n"
-                    info_text += f"Date: {visit['session_date']}\n"
-                    info_text += f"Complaint: {visit['chief_complaint']}\n"
+                    info_text += f"Date: {visit.session_date}\n"
+                    info_text += f"Complaint: {visit.chief_complaint}\n"
             else:
                 info_text += "No previous visits\n"
             
@@ -309,7 +869,7 @@ class MedicalAssistantGUI:
         ttk.Button(dialog, text="Register", command=register).grid(row=4, column=0, columnspan=2, pady=20)
     
     def start_consultation(self):
-        """Start a new consultation"""
+        """Start a new consultation in its own tab"""
         if not self.current_patient_id:
             messagebox.showerror("Error", "Please select a patient first!")
             return
@@ -323,171 +883,113 @@ class MedicalAssistantGUI:
             return
         
         # Create new conversation
-        self.current_conversation_id = self.agent.create_conversation(
+        conversation_id = self.agent.create_conversation(
             self.current_patient_id, 
             complaint
         )
         
-        # Enable chat interface
-        self.send_btn.config(state=tk.NORMAL)
-        self.end_consultation_btn.config(state=tk.NORMAL)
-        
-        # Clear chat display
-        self.chat_display.config(state=tk.NORMAL)
-        self.chat_display.delete(1.0, tk.END)
-        
-        # Display consultation start
-        self.chat_display.insert(tk.END, f"=== CONSULTATION STARTED ===\n", "system")
-        self.chat_display.insert(tk.END, f"Patient: {self.current_patient_id}\n", "system")
-        self.chat_display.insert(tk.END, f"Chief Complaint: {complaint}\n", "system")
-        self.chat_display.insert(tk.END, f"{'='*40}\n\n", "system")
+        patient_info = self.agent.get_patient_info(self.current_patient_id)
+        session = ConsultationSession(self, self.current_patient_id, patient_info.name,
+                                      conversation_id, complaint)
+        self.sessions[str(session.frame)] = session
+        self.notebook.select(session.frame)
+    
+    def open_usage_report(self):
+        """Show recorded token usage and cost, grouped by patient, consultation or call type"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Token Usage")
+        dialog.geometry("900x400")
+        dialog.transient(self.root)
         
-        self.chat_display.config(state=tk.DISABLED)
-        self.chat_display.see(tk.END)
+        groupings = {"Patient": "patient", "Consultation": "conversation", "Call type": "call_type"}
+        
+        controls = ttk.Frame(dialog)
+        controls.pack(fill=tk.X, padx=10, pady=(10, 0))
+        ttk.Label(controls, text="Group by:").pack(side=tk.LEFT)
+        group_var = tk.StringVar(value="Patient")
+        group_combo = ttk.Combobox(controls, textvariable=group_var, values=list(groupings),
+                                   state="readonly", width=15)
+        group_combo.pack(side=tk.LEFT, padx=5)
+        total_label = ttk.Label(controls, text="")
+        total_label.pack(side=tk.RIGHT)
+        
+        columns = ("calls", "prompt", "cached", "output", "avg_prompt", "avg_latency", "estimated", "cost")
+        headings = ("Calls", "Prompt tokens", "Cached", "Output tokens", "Avg prompt",
+                    "Avg latency (ms)", "Estimated", "Cost (USD)")
+        tree = ttk.Treeview(dialog, columns=columns)
+        tree.heading("#0", text="Name")
+        tree.column("#0", width=220)
+        for column, heading in zip(columns, headings):
+            tree.heading(column, text=heading)
+            tree.column(column, width=80, anchor=tk.E)
+        tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        
+        def on_success(totals):
+            if not dialog.winfo_exists():
+                return
+            tree.delete(*tree.get_children())
+            for row in totals:
+                tree.insert("", tk.END, text=row.label, values=(
+                    row.calls, row.prompt_tokens, row.cached_tokens, row.output_tokens,
+                    round(row.avg_prompt_tokens or 0), round(row.avg_latency_ms or 0),
+                    row.estimated_calls, f"{row.cost:.4f}"))
+            total_label.config(text=f"Total: {sum(row.total_tokens for row in totals)} tokens, "
+                                    f"${sum(row.cost for row in totals):.4f}")
+        
+        def on_error(e):
+            if dialog.winfo_exists():
+                messagebox.showerror("Error", f"Failed to load token usage: {str(e)}", parent=dialog)
+        
+        def load(event=None):
+            group_by = groupings[group_var.get()]
+            self.run_in_background(lambda: self.agent.get_usage_report(group_by), on_success, on_error)
+        
+        group_combo.bind("<<ComboboxSelected>>", load)
+        load()
     
-    def send_message(self):
-        """Send a message to the AI assistant"""
-        if not self.current_conversation_id:
-            messagebox.showerror("Error", "No active consultation!")
+    def open_past_consultations_dialog(self):
+        """Let the doctor pick a past consultation of the selected patient to view"""
+        if not self.current_patient_id:
+            messagebox.showerror("Error", "Please select a patient first!")
             return
         
-        message = self.message_input.get(1.0, tk.END).strip()
-        if not message:
+        patient_id = self.current_patient_id
+        patient_info = self.agent.get_patient_info(patient_id)
+        conversations = self.agent.get_patient_conversations(patient_id)
+        if not conversations:
+            messagebox.showinfo("Past Consultations", "No consultations recorded for this patient.")
             return
         
-        # Display user message
-        self.chat_display.config(state=tk.NORMAL)
-        self.chat_display.insert(tk.END, "Doctor: ", "user")
-        self.chat_display.insert(tk.END, f"{message}\n\n")
-        self.chat_display.config(state=tk.DISABLED)
-        self.chat_display.see(tk.END)
-        
-        # Clear input
-        self.message_input.delete(1.0, tk.END)
+        dialog = tk.Toplevel(self.root)
+        dialog.title(f"Past Consultations - {patient_info.name}")
+        dialog.geometry("500x300")
+        dialog.transient(self.root)
         
-        # Disable send button while processing
-        self.send_btn.config(state=tk.DISABLED, text="Processing...")
-        self.root.update()
+        listbox = tk.Listbox(dialog, width=70)
+        listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        for conversation in conversations:
+            listbox.insert(tk.END, f"{conversation.session_date} - {conversation.chief_complaint}")
         
-        try:
-            # Get AI response
-            response = self.agent.chat(
-                self.current_patient_id,
-                self.current_conversation_id,
-                message
-            )
-            
-            # Display AI response
-            self.chat_display.config(state=tk.NORMAL)
-            self.chat_display.insert(tk.END, "Assistant: ", "assistant")
-            self.chat_display.insert(tk.END, f"{response}\n\n")
-            self.chat_display.insert(tk.END, f"{'-'*40}\n\n", "system")
-            self.chat_display.config(state=tk.DISABLED)
-            self.chat_display.see(tk.END)
-            
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to get response: {str(e)}")
+        def open_selected():
+            selection = listbox.curselection()
+            if not selection:
+                return
+            conversation = conversations[selection[0]]
+            dialog.destroy()
+            self.open_transcript(patient_id, patient_info.name, conversation)
         
-        finally:
-            # Re-enable send button
-            self.send_btn.config(state=tk.NORMAL, text="Send")
+        listbox.bind('<Double-Button-1>', lambda event: open_selected())
+        ttk.Button(dialog, text="Open", command=open_selected).pack(pady=(0, 10))
     
-    def end_consultation(self):
-        """End the current consultation with automated summarization"""
-        if not self.current_conversation_id:
-            messagebox.showerror("Error", "No active consultation!")
-            return
-        
-        # Show processing message
-        self.end_consultation_btn.config(text="Generating Summary...", state=tk.DISABLED)
-        self.root.update()
-        
-        try:
-            # Generate automated summary
-            summary_data = self.agent.generate_consultation_summary(self.current_conversation_id)
-            
-            # Fill in the fields automatically
-            self.summary_entry.delete(0, tk.END)
-            self.summary_entry.insert(0, summary_data['summary'])
-            
-            self.symptoms_entry.delete(0, tk.END)
-            self.symptoms_entry.insert(0, summary_data['symptoms'])
-            
-            self.diagnoses_entry.delete(0, tk.END)
-            self.diagnoses_entry.insert(0, summary_data['diagnoses'])
-            
-            # Ask for confirmation
-            response = messagebox.askyesno(
-                "Review Summary",
-                "AI has generated the consultation summary. Would you like to review/edit before saving?\n\n"
-                "Click 'Yes' to review and edit\n"
-                "Click 'No' to save as is"
-            )
-            
-            if response:  # User wants to review
-                self.end_consultation_btn.config(text="Save Consultation", state=tk.NORMAL)
-                messagebox.showinfo("Review Mode", 
-                                "Please review the Summary, Symptoms, and Diagnoses fields below.\n"
-                                "Edit if needed, then click 'Save Consultation' when ready.")
-                
-                # Change button to save mode
-                self.end_consultation_btn.config(command=self.save_consultation_after_review)
+    def open_transcript(self, patient_id: str, patient_name: str, conversation: Visit):
+        """Open a past consultation as a read-only tab, or focus it if already open"""
+        for session in self.sessions.values():
+            if session.conversation_id == conversation.conversation_id:
+                self.notebook.select(session.frame)
                 return
-            
-            # User clicked No - save immediately
-            self.save_final_consultation(summary_data['summary'], 
-                                        summary_data['symptoms'], 
-                                        summary_data['diagnoses'])
-            
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to generate summary: {str(e)}")
-            self.end_consultation_btn.config(text="End Consultation", state=tk.NORMAL)
-
-    def save_consultation_after_review(self):
-        """Save consultation after user has reviewed/edited the summary"""
-        summary = self.summary_entry.get().strip()
-        symptoms = self.symptoms_entry.get().strip()
-        diagnoses = self.diagnoses_entry.get().strip()
-        
-        if not all([summary, symptoms, diagnoses]):
-            messagebox.showwarning("Warning", "Please ensure all fields are filled!")
-            return
-        
-        self.save_final_consultation(summary, symptoms, diagnoses)
-
-    def save_final_consultation(self, summary: str, symptoms: str, diagnoses: str):
-        """Final save of consultation to database"""
-        # Save consultation
-        self.agent.end_conversation(
-            self.current_conversation_id,
-            summary,
-            symptoms,
-            diagnoses
-        )
-        
-        # Display end message in chat
-        self.chat_display.config(state=tk.NORMAL)
-        self.chat_display.insert(tk.END, "\n" + "="*60 + "\n", "system")
-        self.chat_display.insert(tk.END, "=== CONSULTATION ENDED ===\n", "system")
-        self.chat_display.insert(tk.END, f"Summary: {summary}\n", "system")
-        self.chat_display.insert(tk.END, f"Symptoms: {symptoms}\n", "system")
-        self.chat_display.insert(tk.END, f"Diagnoses: {diagnoses}\n", "system")
-        self.chat_display.insert(tk.END, "="*60 + "\n", "system")
-        self.chat_display.config(state=tk.DISABLED)
-        self.chat_display.see(tk.END)
-        
-        # Reset UI
-        self.send_btn.config(state=tk.DISABLED)
-        self.end_consultation_btn.config(text="End Consultation", state=tk.DISABLED, 
-                                        command=self.end_consultation)
-        self.current_conversation_id = None
-        
-        # Clear summary fields
-        self.summary_entry.delete(0, tk.END)
-        self.symptoms_entry.delete(0, tk.END)
-        self.diagnoses_entry.delete(0, tk.END)
-        
-        # Refresh patient info to show new visit
-        self.display_patient_info(self.current_patient_id)
         
-        messagebox.showinfo("Success", "Consultation saved successfully!")
\ No newline at end of file
+        session = ConsultationSession(self, patient_id, patient_name,
+                                      conversation.conversation_id,
+                                      conversation.chief_complaint, read_only=True)
+        self.sessions[str(session.frame)] = session
+        self.notebook.select(session.frame)
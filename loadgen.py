@@ -0,0 +1,286 @@
+"""
+Concurrent load generator and workload replay for MedicalAssistantAgent
+
+Simulated doctors run consultations concurrently against a local stub model:
+register (or pick) a patient, start a conversation, chat for a few turns,
+summarize and end it. Throughput, latency percentiles per operation and
+SQLite lock-contention errors ("database is locked") are reported.
+
+Usage:
+    python loadgen.py [--doctors 8] [--sessions 5] [--turns 2-6] [--think 0.5]
+                      [--new-patient-ratio 0.3] [--model-latency 0.2]
+                      [--db loadgen.db] [--shards 1] [--record trace.jsonl] [--seed 1]
+    python loadgen.py --replay trace.jsonl [--db loadgen.db]
+
+--record writes the generated workload (one operation per line) together
+with the latency observed for it; --replay runs a recorded workload again.
+--shards spreads patients over several databases (see sharding.py).
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from MedicalAssitant import MedicalAssistantAgent
+from sharding import ShardedMedicalAssistant
+
+COMPLAINTS = ["Persistent cough", "Headache", "Chest pain", "Abdominal pain",
+              "Fatigue", "Shortness of breath", "Joint pain", "Dizziness"]
+
+QUERIES = ["Patient reports symptoms worsening over the last three days.",
+           "Any fever, night sweats or weight loss noted?",
+           "Symptoms improve with rest but return on exertion.",
+           "Family history of cardiovascular disease.",
+           "What else should be considered given the history?"]
+
+OPERATIONS = ["register", "start", "chat", "summarize", "end"]
+
+
+class StubResponse:
+    """Minimal stand-in for a Gemini response"""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.usage_metadata = None
+
+
+class StubModel:
+    """Local model replacement with configurable latency"""
+
+    def __init__(self, latency: float = 0.2, jitter: float = 0.5, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt):
+        with self._lock:
+            delay = self.latency * (1 + self._random.uniform(-self.jitter, self.jitter))
+        time.sleep(max(delay, 0))
+
+        if "SUMMARY:" in str(prompt):
+            return StubResponse("SUMMARY: Stub consultation summary.\n"
+                                "SYMPTOMS: cough, fatigue\n"
+                                "DIAGNOSES: viral infection, bronchitis")
+        return StubResponse("- Current presentation: stub analysis\n"
+                            "- Differential considerations: stub\n" * 20)
+
+
+def generate_workload(doctors: int, sessions: int, min_turns: int, max_turns: int,
+                      think: float, new_patient_ratio: float, seed: int) -> List[Dict]:
+    """Build the list of operations each simulated doctor will perform"""
+    rng = random.Random(seed)
+    events = []
+
+    for doctor in range(doctors):
+        # Doctors replay concurrently, so a repeat visit may only pick a
+        # patient this doctor registered earlier in its own sequence
+        known_patients = []
+        for session in range(sessions):
+            if not known_patients or rng.random() < new_patient_ratio:
+                patient_id = f"LG-{doctor:03d}-{session:04d}"
+                known_patients.append(patient_id)
+                events.append({"doctor": doctor, "session": session, "op": "register",
+                               "patient_id": patient_id, "think": 0})
+            else:
+                patient_id = rng.choice(known_patients)
+
+            events.append({"doctor": doctor, "session": session, "op": "start",
+                           "patient_id": patient_id, "complaint": rng.choice(COMPLAINTS),
+                           "think": rng.expovariate(1 / think) if think else 0})
+            for _ in range(rng.randint(min_turns, max_turns)):
+                events.append({"doctor": doctor, "session": session, "op": "chat",
+                               "patient_id": patient_id, "message": rng.choice(QUERIES),
+                               "think": rng.expovariate(1 / think) if think else 0})
+            events.append({"doctor": doctor, "session": session, "op": "summarize",
+                           "patient_id": patient_id, "think": 0})
+            events.append({"doctor": doctor, "session": session, "op": "end",
+                           "patient_id": patient_id, "think": 0})
+
+    return events
+
+
+def load_trace(path: str) -> List[Dict]:
+    """Read a recorded workload"""
+    with open(path, "r", encoding="utf-8") as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
+
+
+class LoadRunner:
+    """Drive the agent with one thread per simulated doctor"""
+
+    def __init__(self, agent: MedicalAssistantAgent, events: List[Dict]):
+        self.agent = agent
+        self.events = events
+        self.results = []
+        self._lock = threading.Lock()
+
+    def run(self) -> float:
+        """Run the workload; returns elapsed wall time in seconds"""
+        by_doctor = defaultdict(list)
+        for event in self.events:
+            by_doctor[event["doctor"]].append(event)
+
+        threads = [threading.Thread(target=self._run_doctor, args=(events,))
+                   for events in by_doctor.values()]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    def _run_doctor(self, events: List[Dict]):
+        conversations = {}
+        summaries = {}
+        failed_sessions = set()
+
+        for event in events:
+            session = event["session"]
+            if session in failed_sessions:
+                continue
+            if event.get("think"):
+                time.sleep(event["think"])
+
+            start = time.perf_counter()
+            error = None
+            try:
+                self._perform(event, conversations, summaries)
+            except Exception as e:
+                error = e
+                failed_sessions.add(session)
+            latency = time.perf_counter() - start
+
+            with self._lock:
+                self.results.append((event, latency, error))
+
+    def _perform(self, event: Dict, conversations: Dict[int, int], summaries: Dict[int, Dict]):
+        op = event["op"]
+        patient_id = event["patient_id"]
+
+        if op == "register":
+            self.agent.register_patient(patient_id, f"Load Patient {patient_id}", 40, "Other")
+        elif op == "start":
+            conversations[event["session"]] = self.agent.create_conversation(
+                patient_id, event["complaint"])
+        elif op == "chat":
+            self.agent.chat(patient_id, conversations[event["session"]], event["message"])
+        elif op == "summarize":
+            summaries[event["session"]] = self.agent.generate_consultation_summary(
+                conversations[event["session"]])
+        elif op == "end":
+            summary = summaries[event["session"]]
+            self.agent.end_conversation(conversations[event["session"]], summary["summary"],
+                                        summary["symptoms"], summary["diagnoses"])
+        else:
+            raise ValueError(f"Unknown operation: {op}")
+
+    def record(self, path: str):
+        """Write the workload and observed latencies as JSONL"""
+        # Keep the planned order, including operations skipped after a failure
+        observed = {id(event): (latency, error) for event, latency, error in self.results}
+        with open(path, "w", encoding="utf-8") as trace_file:
+            for event in self.events:
+                latency, error = observed.get(id(event), (None, None))
+                line = dict(event)
+                line["latency_ms"] = round(latency * 1000, 3) if latency is not None else None
+                line["error"] = str(error) if error else None
+                trace_file.write(json.dumps(line) + "\n")
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[index]
+
+
+def report(results, elapsed: float):
+    """Print throughput, latency percentiles and error counts"""
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    locked = 0
+    sessions_ended = 0
+
+    for event, latency, error in results:
+        latencies[event["op"]].append(latency * 1000)
+        if error:
+            errors[event["op"]] += 1
+            if isinstance(error, sqlite3.OperationalError) and "locked" in str(error):
+                locked += 1
+        elif event["op"] == "end":
+            sessions_ended += 1
+
+    print(f"Elapsed: {elapsed:.2f}s  operations: {len(results)}  "
+          f"throughput: {len(results) / elapsed:.1f} ops/s, {sessions_ended / elapsed:.2f} consultations/s")
+    print(f"{'operation':<10} {'count':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for op in OPERATIONS:
+        values = sorted(latencies.get(op, []))
+        if not values:
+            continue
+        print(f"{op:<10} {len(values):>6} {errors[op]:>6} {percentile(values, 0.50):>9.1f} "
+              f"{percentile(values, 0.95):>9.1f} {percentile(values, 0.99):>9.1f} {values[-1]:>9.1f}")
+    print(f"'database is locked' errors: {locked}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate concurrent load against MedicalAssistantAgent")
+    parser.add_argument("--doctors", type=int, default=8, help="Concurrent simulated doctors")
+    parser.add_argument("--sessions", type=int, default=5, help="Consultations per doctor")
+    parser.add_argument("--turns", default="2-6", help="Chat turns per consultation, MIN-MAX")
+    parser.add_argument("--think", type=float, default=0.5, help="Mean think time between turns (s)")
+    parser.add_argument("--new-patient-ratio", type=float, default=0.3,
+                        help="Share of consultations that register a new patient")
+    parser.add_argument("--model-latency", type=float, default=0.2, help="Stub model latency (s)")
+    parser.add_argument("--background-summaries", action="store_true",
+                        help="Enable speculative background summaries")
+    parser.add_argument("--db", help="SQLite database to use (default: a temporary file)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Number of shard databases (named after --db with a _shardN suffix)")
+    parser.add_argument("--record", help="Write the workload and latencies to this JSONL file")
+    parser.add_argument("--replay", help="Replay a workload recorded with --record")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    args = parser.parse_args()
+
+    if args.replay:
+        events = load_trace(args.replay)
+    else:
+        min_turns, _, max_turns = args.turns.partition("-")
+        events = generate_workload(args.doctors, args.sessions, int(min_turns),
+                                   int(max_turns or min_turns), args.think,
+                                   args.new_patient_ratio, args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = args.db or os.path.join(tmp_dir, "loadgen.db")
+        model = StubModel(args.model_latency, seed=args.seed)
+        if args.shards > 1:
+            stem, ext = os.path.splitext(db_path)
+            agent = ShardedMedicalAssistant("loadgen", [f"{stem}_shard{index}{ext}" for index in range(args.shards)],
+                                            context_caching=False,
+                                            background_summaries=args.background_summaries)
+            for shard in agent.shards:
+                shard.model = model
+        else:
+            agent = MedicalAssistantAgent(api_key="loadgen", db_path=db_path, context_caching=False,
+                                          background_summaries=args.background_summaries)
+            agent.model = model
+
+        runner = LoadRunner(agent, events)
+        elapsed = runner.run()
+        report(runner.results, elapsed)
+
+        if args.record:
+            runner.record(args.record)
+            print(f"Trace written to {args.record}")
+
+
+if __name__ == "__main__":
+    main()
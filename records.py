@@ -0,0 +1,66 @@
+from collections import namedtuple
+from typing import Any
+
+
+def record_type(name: str, fields: str, doc: str):
+    """
+    Build a compact named-tuple record type for rows returned by the agent
+
+    Records are tuples (no per-row dict) and are built directly from sqlite3
+    result rows via row_factory. They also accept key access
+    (record['name']) so code written against the old dict rows keeps
+    working. Fields not selected by a query default to None.
+    """
+    field_names = fields.split()
+    base = namedtuple(name, field_names, defaults=(None,) * len(field_names))
+
+    def __getitem__(self, key: Any) -> Any:
+        if isinstance(key, str):
+            if key not in self._fields:
+                raise KeyError(key)
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key) if key in self._fields else default
+
+    def row_factory(cls, cursor, row):
+        """sqlite3 row factory building records straight from result tuples"""
+        missing = len(cls._fields) - len(row)
+        return tuple.__new__(cls, row + (None,) * missing if missing else row)
+
+    return type(name, (base,), {
+        "__slots__": (),
+        "__doc__": doc,
+        "__getitem__": __getitem__,
+        "get": get,
+        "keys": lambda self: self._fields,
+        "row_factory": classmethod(row_factory),
+    })
+
+
+Patient = record_type(
+    "Patient", "patient_id name age gender created_at",
+    "A row of the patients table")
+
+Visit = record_type(
+    "Visit", "conversation_id session_date chief_complaint summary",
+    "A consultation (conversations row) as listed for a patient")
+
+Message = record_type(
+    "Message", "message_id role content timestamp",
+    "A single chat message")
+
+HistoryEntry = record_type(
+    "HistoryEntry", "session_date chief_complaint summary symptoms diagnoses_considered",
+    "A past visit joined with the symptoms and diagnoses archived for it")
+
+ChatTurn = record_type(
+    "ChatTurn", "response user_message_id response_message_id",
+    "The assistant's response to a chat turn and the message_ids stored for it")
+
+UsageTotals = record_type(
+    "UsageTotals",
+    "key label calls prompt_tokens cached_tokens output_tokens total_tokens "
+    "avg_prompt_tokens avg_latency_ms estimated_calls cost",
+    "Token usage aggregated by patient, conversation or call type")
@@ -0,0 +1,379 @@
+"""
+Sharded deployment of MedicalAssistantAgent over several SQLite files
+
+Each patient lives on exactly one shard, chosen by clinic (the patient ID
+prefix before CLINIC_SEPARATOR, when mapped) or otherwise by rendezvous
+hashing of the patient ID. Every shard is a regular MedicalAssistantAgent
+database with its own write lock, so consultations on different shards do
+not contend with each other.
+
+Conversation IDs are allocated from disjoint ranges (SHARD_ID_SPACE per
+shard), so conversation-keyed calls are routed without a lookup.
+
+Usage:
+    python sharding.py status    --shard a.db --shard b.db [--clinic NORTH=0]
+    python sharding.py rebalance --shard a.db --shard b.db [--clinic NORTH=0] [--dry-run]
+
+Run rebalance after adding a shard or changing the clinic map; it moves every
+patient whose data is not on the shard the current configuration routes them to.
+"""
+import argparse
+import heapq
+import itertools
+import os
+import sqlite3
+import zlib
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from MedicalAssitant import MedicalAssistantAgent
+from records import Patient
+
+# Conversation IDs reserved per shard: shard i allocates from i * SHARD_ID_SPACE
+SHARD_ID_SPACE = 10 ** 12
+
+# Separates the clinic key from the rest of a patient ID (e.g. NORTH-00123)
+CLINIC_SEPARATOR = "-"
+
+
+def _by_patient(name: str):
+    """Delegate an agent method taking patient_id first to the patient's shard"""
+    def method(self, patient_id: str, *args, **kwargs):
+        return getattr(self.agent_for_patient(patient_id), name)(patient_id, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = f"MedicalAssistantAgent.{name} on the patient's shard"
+    return method
+
+
+def _by_conversation(name: str):
+    """Delegate an agent method taking conversation_id first to the conversation's shard"""
+    def method(self, conversation_id: int, *args, **kwargs):
+        return getattr(self.agent_for_conversation(conversation_id), name)(conversation_id, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = f"MedicalAssistantAgent.{name} on the conversation's shard"
+    return method
+
+
+class ShardedMedicalAssistant:
+    """
+    Route MedicalAssistantAgent calls to one of several shard databases
+
+    Exposes the agent's patient- and conversation-level API, so it can stand
+    in for a single agent; listing and search fan out to every shard.
+    """
+
+    def __init__(self, api_key: str, shard_paths: List[str],
+                 clinics: Optional[Dict[str, int]] = None, **agent_options):
+        """
+        Args:
+            api_key: Google AI API key for Gemini
+            shard_paths: SQLite file per shard; order defines shard indexes, so
+                         only append new shards (an existing single database
+                         can be used as shard 0)
+            clinics: Clinic key -> shard index; other patients are hashed
+            agent_options: Passed to each shard's MedicalAssistantAgent
+        """
+        if not shard_paths:
+            raise ValueError("At least one shard is required")
+        self.clinics = dict(clinics or {})
+        for clinic, index in self.clinics.items():
+            if not 0 <= index < len(shard_paths):
+                raise ValueError(f"Clinic {clinic} mapped to unknown shard {index}")
+
+        self.shards = [MedicalAssistantAgent(api_key, db_path=path, **agent_options)
+                       for path in shard_paths]
+        for index, shard in enumerate(self.shards):
+            self.reserve_conversation_ids(shard, index)
+
+    def reserve_conversation_ids(self, shard: MedicalAssistantAgent, index: int):
+        """Start the shard's conversation IDs at the beginning of its range"""
+        base = index * SHARD_ID_SPACE
+        conn = sqlite3.connect(shard.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute("""
+            SELECT MIN(conversation_id), MAX(conversation_id) FROM conversations
+        """)
+        low, high = cursor.fetchone()
+        if low is not None and (low < base or high >= base + SHARD_ID_SPACE):
+            conn.close()
+            raise ValueError(f"Shard {index} ({shard.db_path}) holds conversation IDs "
+                             f"outside its range; existing databases can only be shard 0")
+
+        cursor.execute("""
+            INSERT INTO sqlite_sequence (name, seq)
+            SELECT 'conversations', 0
+            WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'conversations')
+        """)
+        cursor.execute("""
+            UPDATE sqlite_sequence SET seq = ?
+            WHERE name = 'conversations' AND seq < ?
+        """, (base, base))
+
+        conn.commit()
+        conn.close()
+
+    def shard_index(self, patient_id: str) -> int:
+        """Shard a patient belongs on under the current configuration"""
+        clinic = patient_id.split(CLINIC_SEPARATOR, 1)[0]
+        if clinic in self.clinics:
+            return self.clinics[clinic]
+        # Rendezvous hashing: adding a shard only moves the patients it wins
+        return max(range(len(self.shards)),
+                   key=lambda index: zlib.crc32(f"{index}:{patient_id}".encode("utf-8")))
+
+    def agent_for_patient(self, patient_id: str) -> MedicalAssistantAgent:
+        return self.shards[self.shard_index(patient_id)]
+
+    def agent_for_conversation(self, conversation_id: int) -> MedicalAssistantAgent:
+        index = conversation_id // SHARD_ID_SPACE
+        if not 0 <= index < len(self.shards):
+            raise ValueError(f"Conversation {conversation_id} does not belong to any shard")
+        return self.shards[index]
+
+    # Patient-level API
+    register_patient = _by_patient("register_patient")
+    get_patient_info = _by_patient("get_patient_info")
+    get_patient_history = _by_patient("get_patient_history")
+    get_patient_conversations = _by_patient("get_patient_conversations")
+    get_patient_summary = _by_patient("get_patient_summary")
+    build_context_prompt = _by_patient("build_context_prompt")
+    prefetch_patient_context = _by_patient("prefetch_patient_context")
+    create_conversation = _by_patient("create_conversation")
+    chat = _by_patient("chat")
+    chat_turn = _by_patient("chat_turn")
+    save_patient_history_entry = _by_patient("save_patient_history_entry")
+    clear_patient_data = _by_patient("clear_patient_data")
+
+    # Conversation-level API
+    save_message = _by_conversation("save_message")
+    get_conversation_messages = _by_conversation("get_conversation_messages")
+    iter_conversation_messages = _by_conversation("iter_conversation_messages")
+    end_conversation = _by_conversation("end_conversation")
+    generate_consultation_summary = _by_conversation("generate_consultation_summary")
+    get_draft_summary = _by_conversation("get_draft_summary")
+    discard_draft_summary = _by_conversation("discard_draft_summary")
+
+    def get_all_patients(self) -> List[Patient]:
+        """All patients across shards, ordered by name"""
+        return list(heapq.merge(*(shard.get_all_patients() for shard in self.shards),
+                                key=lambda patient: patient.name or ""))
+
+    def search_patients(self, query: str, limit: int = 50) -> List[Patient]:
+        """Patients on any shard whose name or ID contains query, ordered by name"""
+        results = [shard.search_patients(query, limit) for shard in self.shards]
+        return list(itertools.islice(heapq.merge(*results, key=lambda patient: patient.name or ""),
+                                     limit))
+
+    def invalidate_patient_context(self, patient_id: Optional[str] = None):
+        if patient_id is None:
+            for shard in self.shards:
+                shard.invalidate_patient_context()
+        else:
+            self.agent_for_patient(patient_id).invalidate_patient_context(patient_id)
+
+    def archive_old_conversations(self, *args, **kwargs) -> int:
+        """Archive old consultations on every shard; returns the total archived"""
+        return sum(shard.archive_old_conversations(*args, **kwargs) for shard in self.shards)
+
+    def clear_all_data(self) -> bool:
+        """Clear every shard (WARNING: Irreversible!)"""
+        return all([shard.clear_all_data() for shard in self.shards])
+
+    def misplaced_patients(self) -> Iterator[Tuple[str, int, int]]:
+        """Yield (patient_id, current shard, target shard) for patients on the wrong shard"""
+        for index, shard in enumerate(self.shards):
+            for patient in shard.get_all_patients():
+                target = self.shard_index(patient.patient_id)
+                if target != index:
+                    yield patient.patient_id, index, target
+
+    def rebalance(self, progress: Optional[Callable[[str, int, int], None]] = None) -> int:
+        """
+        Move every misplaced patient to the shard it is routed to
+
+        Stop consultations first: moved conversations get new IDs in the
+        target shard's range. Returns the number of patients moved.
+        """
+        moves = list(self.misplaced_patients())
+        for patient_id, source, target in moves:
+            self.move_patient(patient_id, source, target)
+            if progress:
+                progress(patient_id, source, target)
+        return len(moves)
+
+    def move_patient(self, patient_id: str, source: int, target: int):
+        """
+        Move a patient and all their rows from one shard to another
+
+        The copy and the deletion run in one transaction across both shards
+        (and their archives). Bodies are re-encoded with the target's codec,
+        since compression dictionaries are per shard.
+
+        In WAL mode that transaction commits file by file, target first, so
+        an interrupted move can leave a copy on the target while the source
+        is still complete. Any such copy is dropped before copying, which
+        makes a failed move safe to retry.
+        """
+        src, dst = self.shards[source], self.shards[target]
+        dst.init_archive_database()
+
+        conn = dst.connect_with_archive()
+        conn.execute("ATTACH DATABASE ? AS src", (src.db_path,))
+        src_archive = os.path.exists(src.archive_path)
+        if src_archive:
+            conn.execute("ATTACH DATABASE ? AS src_archive", (src.archive_path,))
+        cursor = conn.cursor()
+
+        moved_conversations = []
+        try:
+            cursor.execute("SELECT conversation_id FROM main.conversations WHERE patient_id = ?",
+                           (patient_id,))
+            for (stale_id,) in cursor.fetchall():
+                for table in ("main.messages", "archive.messages", "main.patient_history", "main.usage"):
+                    cursor.execute(f"DELETE FROM {table} WHERE conversation_id = ?", (stale_id,))
+            for table in ("main.conversations", "main.usage", "main.patient_summaries", "main.patients"):
+                cursor.execute(f"DELETE FROM {table} WHERE patient_id = ?", (patient_id,))
+
+            cursor.execute("""
+                INSERT INTO main.patients (patient_id, name, age, gender, created_at)
+                SELECT patient_id, name, age, gender, created_at
+                FROM src.patients WHERE patient_id = ?
+            """, (patient_id,))
+            if cursor.rowcount == 0:
+                raise ValueError(f"Patient {patient_id} not found on shard {source}")
+
+            cursor.execute("""
+                SELECT conversation_id, session_date, chief_complaint, summary, archived
+                FROM src.conversations
+                WHERE patient_id = ?
+                ORDER BY conversation_id
+            """, (patient_id,))
+            conversations = cursor.fetchall()
+
+            for old_id, session_date, chief_complaint, summary, archived in conversations:
+                cursor.execute("""
+                    INSERT INTO main.conversations
+                    (patient_id, session_date, chief_complaint, summary, archived)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (patient_id, session_date, chief_complaint, summary, archived))
+                new_id = cursor.lastrowid
+                moved_conversations.append(old_id)
+
+                # New message IDs come from the target's sequence, even for
+                # archived conversations, so they never collide on archiving
+                messages_table = "src_archive.messages" if archived and src_archive else "src.messages"
+                cursor.execute(f"""
+                    SELECT role, content, timestamp, content_encoding
+                    FROM {messages_table}
+                    WHERE conversation_id = ?
+                    ORDER BY message_id
+                """, (old_id,))
+                for role, content, timestamp, encoding in cursor.fetchall():
+                    content, encoding = dst.codec.encode(src.codec.decode(content, encoding))
+                    cursor.execute("""
+                        INSERT INTO main.messages (conversation_id, role, content, timestamp, content_encoding)
+                        VALUES (?, ?, ?, ?, ?)
+                    """, (new_id, role, content, timestamp, encoding))
+
+                if archived:
+                    cursor.execute("""
+                        INSERT INTO archive.messages
+                        (message_id, conversation_id, role, content, timestamp, content_encoding)
+                        SELECT message_id, conversation_id, role, content, timestamp, content_encoding
+                        FROM main.messages WHERE conversation_id = ?
+                    """, (new_id,))
+                    cursor.execute("DELETE FROM main.messages WHERE conversation_id = ?", (new_id,))
+
+                cursor.execute("""
+                    INSERT INTO main.patient_history
+                    (patient_id, conversation_id, symptoms, diagnoses_considered, timestamp)
+                    SELECT patient_id, ?, symptoms, diagnoses_considered, timestamp
+                    FROM src.patient_history WHERE conversation_id = ?
+                """, (new_id, old_id))
+                cursor.execute("""
+                    INSERT INTO main.usage
+                    (conversation_id, patient_id, call_type, prompt_tokens, cached_tokens,
+                     output_tokens, total_tokens, estimated, latency_ms, created_at)
+                    SELECT ?, patient_id, call_type, prompt_tokens, cached_tokens,
+                           output_tokens, total_tokens, estimated, latency_ms, created_at
+                    FROM src.usage WHERE conversation_id = ?
+                """, (new_id, old_id))
+
+                cursor.execute("DELETE FROM src.messages WHERE conversation_id = ?", (old_id,))
+                if src_archive:
+                    cursor.execute("DELETE FROM src_archive.messages WHERE conversation_id = ?", (old_id,))
+                cursor.execute("DELETE FROM src.patient_history WHERE conversation_id = ?", (old_id,))
+                cursor.execute("DELETE FROM src.usage WHERE conversation_id = ?", (old_id,))
+                cursor.execute("DELETE FROM src.conversations WHERE conversation_id = ?", (old_id,))
+
+            cursor.execute("""
+                SELECT visit_count, visits_text, visits_encoding, updated_at
+                FROM src.patient_summaries WHERE patient_id = ?
+            """, (patient_id,))
+            summary_row = cursor.fetchone()
+            if summary_row:
+                visit_count, visits_text, encoding, updated_at = summary_row
+                visits_text, encoding = dst.codec.encode(src.codec.decode(visits_text, encoding))
+                cursor.execute("""
+                    INSERT INTO main.patient_summaries
+                    (patient_id, visit_count, visits_text, visits_encoding, updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (patient_id, visit_count, visits_text, encoding, updated_at))
+
+            cursor.execute("DELETE FROM src.usage WHERE patient_id = ?", (patient_id,))
+            cursor.execute("DELETE FROM src.patient_summaries WHERE patient_id = ?", (patient_id,))
+            cursor.execute("DELETE FROM src.patients WHERE patient_id = ?", (patient_id,))
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        for conversation_id in moved_conversations:
+            src.discard_draft_summary(conversation_id)
+        src.invalidate_patient_context(patient_id)
+        dst.invalidate_patient_context(patient_id)
+
+
+def parse_clinics(values: List[str]) -> Dict[str, int]:
+    """Parse CLINIC=INDEX arguments"""
+    clinics = {}
+    for value in values:
+        clinic, _, index = value.partition("=")
+        clinics[clinic] = int(index)
+    return clinics
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or rebalance sharded medical assistant databases")
+    parser.add_argument("command", choices=["status", "rebalance"])
+    parser.add_argument("--shard", action="append", required=True,
+                        help="Shard database, in shard order (repeat for each shard)")
+    parser.add_argument("--clinic", action="append", default=[],
+                        help="Pin a clinic's patients to a shard, CLINIC=INDEX")
+    parser.add_argument("--dry-run", action="store_true", help="List moves without performing them")
+    args = parser.parse_args()
+
+    router = ShardedMedicalAssistant("", args.shard, parse_clinics(args.clinic),
+                                     context_caching=False, background_summaries=False)
+
+    if args.command == "status":
+        misplaced = {}
+        for _, source, _ in router.misplaced_patients():
+            misplaced[source] = misplaced.get(source, 0) + 1
+        for index, shard in enumerate(router.shards):
+            print(f"shard {index} {shard.db_path}: {len(shard.get_all_patients())} patients, "
+                  f"{misplaced.get(index, 0)} to move")
+    elif args.dry_run:
+        for patient_id, source, target in router.misplaced_patients():
+            print(f"{patient_id}: shard {source} -> shard {target}")
+    else:
+        moved = router.rebalance(lambda patient_id, source, target:
+                                 print(f"{patient_id}: shard {source} -> shard {target}"))
+        print(f"Moved {moved} patients")
+
+
+if __name__ == "__main__":
+    main()